@@ -0,0 +1,380 @@
+#!/usr/bin/env python
+"""
+Deploy benchmarks against local containers.
+
+Starts `--hosts` containers running sshd (benchmarks/Dockerfile) as the
+hosts of a `bench` stage and deploys a sample django project on them with
+the fab command of the current environment, using the dploy of this
+working tree:
+
+- cold: first deploy on fresh hosts
+- warm: deploy of a new commit
+- noop: deploy again, nothing changed
+
+The wall time, the number of SSH round-trips (remote commands and
+transfers) and the bytes transferred of each phase are read from the deploy
+traces and written to a JSON results file. The benchmark fails (exit status
+1) when a task made more round-trips than its budget (see dploy.trace) or,
+with --baseline, when one of them got worse than in the baseline by more
+than --threshold.
+
+Requires docker, git and ssh-keygen:
+
+    python benchmarks/run.py --output baseline.json
+    python benchmarks/run.py --baseline baseline.json --since origin/master
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+SCENARIOS = ('cold', 'warm', 'noop')
+# Paths whose changes are benchmarked (see --since)
+WATCHED = ('dploy/tasks', 'dploy/context.py')
+# Time regressions under this many seconds are noise
+TIME_NOISE = 0.5
+
+SAMPLE_FILES = {
+    'requirements.txt': 'Django>=1.11,<2.3\nuWSGI\n',
+    'manage.py': (
+        '#!/usr/bin/env python\n'
+        'import os, sys\n'
+        'os.environ.setdefault("DJANGO_SETTINGS_MODULE", "sample.settings")\n'
+        'from django.core.management import execute_from_command_line\n'
+        'execute_from_command_line(sys.argv)\n'),
+    'sample/__init__.py': '',
+    'sample/settings.py': (
+        'SECRET_KEY = "sample"\n'
+        'INSTALLED_APPS = ["django.contrib.contenttypes",\n'
+        '                  "django.contrib.auth",\n'
+        '                  "django.contrib.staticfiles"]\n'
+        'ROOT_URLCONF = "sample.urls"\n'
+        'DATABASES = {"default": {"ENGINE": "django.db.backends.sqlite3",\n'
+        '                         "NAME": "/tmp/sample.sqlite3"}}\n'
+        'STATIC_URL = "/static/"\n'
+        'try:\n'
+        '    from .local_settings import *  # noqa\n'
+        'except ImportError:\n'
+        '    pass\n'),
+    'sample/urls.py': 'urlpatterns = []\n',
+    'sample/wsgi.py': (
+        'import os\n'
+        'os.environ.setdefault("DJANGO_SETTINGS_MODULE", "sample.settings")\n'
+        'from django.core.wsgi import get_wsgi_application\n'
+        'application = get_wsgi_application()\n'),
+    'sample/static/sample.css': 'body { margin: 0; }\n',
+}
+
+SETTINGS_TEMPLATE = (
+    'DEBUG = False\n'
+    'ALLOWED_HOSTS = ["*"]\n'
+    'STATIC_ROOT = "{{ ctx("django.dirs.static_root") }}"\n'
+    'STATICFILES_DIRS = ["{{ project_dir }}/sample/static"]\n')
+
+DPLOY_YML = """global:
+    python:
+        version: 3
+    django:
+        project_name: 'sample'
+    git:
+        repository: '/srv/sample.git'
+stages:
+    bench:
+        hosts: {hosts}
+        nginx:
+            server_name: 'bench.local'
+            server_ip: '0.0.0.0'
+        deploy:
+            parallel: true
+"""
+
+# The secrets of the stage, kept on the hosts (see dploy.context)
+STAGE_CONTEXT_PATH = '/root/.context/sample/bench.yml'
+STAGE_CONTEXT = """django:
+    secret_key: 'bench'
+"""
+
+FABFILE = """import os
+from dploy.tasks import *  # noqa
+env.base_path = os.path.dirname(__file__)
+"""
+
+
+def sh(*args, **kwargs):
+    return subprocess.check_output(args, **kwargs).decode('utf-8')
+
+
+def write(path, content):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as fd:
+        fd.write(content)
+
+
+def create_sample(workdir):
+    """
+    Creates the sample project repository and its bare clone, the hosts
+    clone it from /srv/sample.git
+    """
+    sample = os.path.join(workdir, 'sample')
+    for name, content in SAMPLE_FILES.items():
+        write(os.path.join(sample, name), content)
+    sh('git', 'init', '-q', sample)
+    commit(sample, 'Sample project')
+    bare = os.path.join(workdir, 'sample.git')
+    sh('git', 'clone', '-q', '--bare', sample, bare)
+    sh('git', 'remote', 'add', 'origin', bare, cwd=sample)
+    return sample, bare
+
+
+def commit(sample, message):
+    sh('git', 'add', '-A', cwd=sample)
+    sh('git', '-c', 'user.name=bench', '-c', 'user.email=bench@localhost',
+       'commit', '-q', '-m', message, cwd=sample)
+
+
+def wait_ssh(port, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.5)
+    sys.exit('sshd did not start on port {}'.format(port))
+
+
+def start_hosts(count, image, port, public_key, bare):
+    """
+    Starts the host containers, returns their (names, host strings)
+    """
+    names, hosts = [], []
+    for i in range(count):
+        name = 'dploy-bench-{}'.format(i)
+        subprocess.call(['docker', 'rm', '-f', name],
+                        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        sh('docker', 'run', '-d', '--name', name,
+           '-p', '127.0.0.1:{}:22'.format(port + i),
+           '-e', 'AUTHORIZED_KEY={}'.format(public_key),
+           '-v', '{}:/srv/sample.git'.format(bare), image)
+        names.append(name)
+        hosts.append('root@127.0.0.1:{}'.format(port + i))
+    for i in range(count):
+        wait_ssh(port + i)
+    return names, hosts
+
+
+def write_stage_context(names):
+    """
+    Writes the stage context on the hosts, deploys abort without it
+    """
+    for name in names:
+        process = subprocess.Popen(
+            ['docker', 'exec', '-i', name, 'sh', '-c',
+             'mkdir -p {} && cat > {}'.format(
+                 os.path.dirname(STAGE_CONTEXT_PATH), STAGE_CONTEXT_PATH)],
+            stdin=subprocess.PIPE)
+        process.communicate(STAGE_CONTEXT.encode('utf-8'))
+        if process.returncode != 0:
+            sys.exit('Could not write the stage context on {}'.format(name))
+
+
+def stop_hosts(names):
+    for name in names:
+        subprocess.call(['docker', 'rm', '-f', name],
+                        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+
+def deploy(project, key, scenario):
+    """
+    Deploys the sample project, returns (wall time, trace spans)
+    """
+    trace_path = os.path.join(project, 'dploy-trace-bench.json')
+    if os.path.exists(trace_path):
+        os.remove(trace_path)
+    environ = dict(os.environ)
+    environ['PYTHONPATH'] = os.pathsep.join(
+        [ROOT_DIR] + [p for p in [environ.get('PYTHONPATH')] if p])
+    print('--- {} deploy'.format(scenario))
+    start = time.time()
+    status = subprocess.call(
+        ['fab', '-i', key, '--disable-known-hosts', 'on:bench', 'deploy'],
+        cwd=project, env=environ)
+    wall = time.time() - start
+    if status != 0:
+        sys.exit('The {} deploy failed'.format(scenario))
+    with open(trace_path, 'r') as fd:
+        spans = json.load(fd)['spans']
+    shutil.move(trace_path, os.path.join(
+        project, 'dploy-trace-bench-{}.json'.format(scenario)))
+    return wall, spans
+
+
+def measure(wall, spans):
+    """
+    Returns the wall time and the remote commands/bytes of a deploy, in
+    total and per phase (the time of a phase is its longest host)
+    """
+    phases = {}
+    for s in spans:
+        if not s.get('phase'):
+            continue
+        phase = phases.setdefault(
+            s['phase'], {'time': 0, 'commands': 0, 'bytes': 0})
+        if s['kind'] == 'phase':
+            phase['time'] = max(phase['time'], s['duration'])
+        elif s['kind'] in ('exec', 'transfer'):
+            phase['commands'] += 1
+            phase['bytes'] += s.get('bytes', 0)
+    return {
+        'time': wall,
+        'commands': sum(p['commands'] for p in phases.values()),
+        'bytes': sum(p['bytes'] for p in phases.values()),
+        'phases': phases,
+        'over_budget': [
+            [s['name'], s['host'], s['round_trips'], s['budget']]
+            for s in spans if s['kind'] == 'task' and
+            s.get('budget') is not None and s['round_trips'] > s['budget']],
+    }
+
+
+def regressions(baseline, results, threshold):
+    """
+    Returns the (scenario, phase, metric, before, after) that got worse
+    than the baseline by more than `threshold` (ratio)
+    """
+    found = []
+    for scenario, after in results.items():
+        before = baseline.get(scenario)
+        if before is None:
+            continue
+        pairs = [(None, before, after)] + [
+            (name, before['phases'][name], phase)
+            for name, phase in sorted(after['phases'].items())
+            if name in before['phases']]
+        for name, old, new in pairs:
+            for metric in ('time', 'commands', 'bytes'):
+                if new[metric] <= old[metric] * (1 + threshold):
+                    continue
+                if metric == 'time' and \
+                        new[metric] - old[metric] < TIME_NOISE:
+                    continue
+                found.append((scenario, name, metric, old[metric],
+                              new[metric]))
+    return found
+
+
+def print_results(results):
+    print('{:<6} {:<32} {:>9} {:>9} {:>12}'.format(
+        'Run', 'Phase', 'Seconds', 'Commands', 'Bytes'))
+    for scenario in SCENARIOS:
+        result = results.get(scenario)
+        if result is None:
+            continue
+        rows = [('<total>', result)] + sorted(result['phases'].items())
+        for name, metrics in rows:
+            print('{:<6} {:<32} {:>9.2f} {:>9} {:>12}'.format(
+                scenario, name[:32], metrics['time'], metrics['commands'],
+                metrics['bytes']))
+
+
+def watched_changes(ref):
+    """
+    Returns True if the watched paths changed since a git ref
+    """
+    return subprocess.call(['git', 'diff', '--quiet', ref, '--'] +
+                           list(WATCHED), cwd=ROOT_DIR) != 0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--hosts', type=int, default=3)
+    parser.add_argument('--image', default='dploy-bench-host')
+    parser.add_argument('--build', action='store_true',
+                        help='build the host image first')
+    parser.add_argument('--port', type=int, default=22200,
+                        help='ssh port of the first host')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--output', help='write the results to a file')
+    parser.add_argument('--baseline', help='results to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2)
+    parser.add_argument('--since', help='only run if {} changed since '
+                        'this git ref'.format(', '.join(WATCHED)))
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the hosts and the work directory')
+    args = parser.parse_args()
+
+    if args.since and not watched_changes(args.since):
+        print('No changes to {} since {}, skipping.'.format(
+            ', '.join(WATCHED), args.since))
+        return 0
+    if args.build:
+        subprocess.check_call(['docker', 'build', '-t', args.image,
+                               BENCH_DIR])
+
+    workdir = tempfile.mkdtemp(prefix='dploy-bench-')
+    key = os.path.join(workdir, 'id_rsa')
+    sh('ssh-keygen', '-q', '-t', 'rsa', '-N', '', '-f', key)
+    with open(key + '.pub', 'r') as fd:
+        public_key = fd.read().strip()
+    sample, bare = create_sample(workdir)
+    names, hosts = start_hosts(args.hosts, args.image, args.port,
+                               public_key, bare)
+    write_stage_context(names)
+
+    project = os.path.join(workdir, 'project')
+    write(os.path.join(project, 'dploy.yml'),
+          DPLOY_YML.format(hosts=json.dumps(hosts)))
+    write(os.path.join(project, 'fabfile.py'), FABFILE)
+    write(os.path.join(project, 'dploy', 'bench_settings.py'),
+          SETTINGS_TEMPLATE)
+
+    results = {}
+    try:
+        for scenario in args.scenarios.split(','):
+            if scenario == 'warm':
+                write(os.path.join(sample, 'sample', 'static', 'sample.css'),
+                      'body {{ margin: {}px; }}\n'.format(int(time.time())))
+                commit(sample, 'Change')
+                sh('git', 'push', '-q', 'origin', 'HEAD', cwd=sample)
+            results[scenario] = measure(*deploy(project, key, scenario))
+    finally:
+        if args.keep:
+            print('Hosts and work directory kept: {}'.format(workdir))
+        else:
+            stop_hosts(names)
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as fd:
+            json.dump(results, fd, indent=2, sort_keys=True)
+    status = 0
+    for scenario, result in sorted(results.items()):
+        for name, host, round_trips, budget in result['over_budget']:
+            print('OVER BUDGET {} {} on {}: {} round-trips (budget: '
+                  '{})'.format(scenario, name, host, round_trips, budget))
+            status = 1
+    if args.baseline:
+        with open(args.baseline, 'r') as fd:
+            baseline = json.load(fd)
+        found = regressions(baseline, results, args.threshold)
+        for scenario, phase, metric, before, after in found:
+            print('REGRESSION {} {} {}: {} -> {}'.format(
+                scenario, phase or '<total>', metric, before, after))
+        if found:
+            status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
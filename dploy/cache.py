@@ -0,0 +1,98 @@
+"""
+Local encrypted cache of the stage contexts fetched from the hosts.
+
+Contents are stored encrypted (Fernet, from the cryptography package that
+paramiko already depends on) and named after their sha1, an index records
+the digest last fetched from each host so the next runs only have to check
+that it did not change. The key is read from DPLOY_CACHE_KEY or generated
+in the cache directory (DPLOY_CACHE_DIR, ~/.cache/dploy by default).
+"""
+import os
+import json
+import hashlib
+
+try:
+    from cryptography.fernet import Fernet, InvalidToken
+except ImportError:  # The cache is disabled
+    Fernet = None
+
+
+def get_cache_dir():
+    return os.path.expanduser(
+        os.environ.get('DPLOY_CACHE_DIR', '~/.cache/dploy'))
+
+
+def enabled():
+    return Fernet is not None
+
+
+def write_private(path, content):
+    """
+    Writes a file only readable by the current user
+    """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(content)
+
+
+def get_fernet():
+    key = os.environ.get('DPLOY_CACHE_KEY')
+    if not key:
+        path = os.path.join(get_cache_dir(), 'key')
+        if not os.path.exists(path):
+            write_private(path, Fernet.generate_key())
+        with open(path, 'rb') as fd:
+            key = fd.read().strip()
+    return Fernet(key)
+
+
+def get_index_path(name):
+    return os.path.join(get_cache_dir(), name, 'index.json')
+
+
+def get_index(name):
+    """
+    Returns the {host: value} index of a cache (ex: the digests of
+    <project>-<stage>)
+    """
+    try:
+        with open(get_index_path(name), 'r') as fd:
+            return json.load(fd)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def save_index(name, index):
+    write_private(get_index_path(name),
+                  json.dumps(index, indent=2, sort_keys=True).encode('utf-8'))
+
+
+def read(name, digest):
+    """
+    Returns a cached content, None if it is missing, cannot be decrypted
+    or does not match its digest
+    """
+    if not enabled() or not digest:
+        return None
+    try:
+        with open(os.path.join(get_cache_dir(), name, digest), 'rb') as fd:
+            content = get_fernet().decrypt(fd.read())
+    except (IOError, OSError, InvalidToken):
+        return None
+    if hashlib.sha1(content).hexdigest() != digest:
+        return None
+    return content
+
+
+def write(name, content):
+    """
+    Stores a content and returns its digest
+    """
+    digest = hashlib.sha1(content).hexdigest()
+    if enabled():
+        write_private(os.path.join(get_cache_dir(), name, digest),
+                      get_fernet().encrypt(content))
+    return digest
@@ -1,19 +1,57 @@
-import os
+import re
 
-from fabric.api import cd, sudo
+from fabric.api import cd, sudo, hide, settings
+from fabric.colors import red
+from fabric.utils import abort
 
-from dploy.context import ctx, get_project_dir
+from dploy.context import ctx, get_release_dir, get_venv_path
+from dploy.utils import quote
+from dploy.trace import span
+
+BATCH_MARKER = '__dploy_batch__'
+BATCH_STATUS = re.compile(r'^{} (\d+) (\d+)$'.format(BATCH_MARKER))
+
+
+def venv_command(i):
+    return '{}/bin/{}'.format(get_venv_path(), i)
+
+
+def python_command(i):
+    if ctx('python.version') == 3:
+        return venv_command('python3 {}'.format(i))
+    else:
+        return venv_command('python2 {}'.format(i))
+
+
+def manage_command(i):
+    return python_command('manage.py {}'.format(i))
+
+
+def chown_command(paths, recursive=True):
+    """
+    Returns a command giving the paths (and what is under them when
+    `recursive`) to system.user:system.group. Only the entries owned by
+    someone else are changed, unlike `chown -R` which rewrites every inode,
+    and the paths that do not exist are skipped.
+    """
+    user, group = ctx('system.user'), ctx('system.group')
+    return (
+        'for p in {paths}; do if [ -e "$p" ]; then '
+        'find -H "$p" {depth}\\( ! -user {user} -o ! -group {group} \\) '
+        '-exec chown -h {owner} {{}} + || exit 1; fi; done'.format(
+            paths=' '.join(quote(p) for p in paths),
+            depth='' if recursive else '-maxdepth 0 ',
+            user=quote(user), group=quote(group),
+            owner=quote('{}:{}'.format(user, group))))
 
 
 def venv(i):
-    venv_path = os.path.join(
-        ctx('virtualenv.dirs.root'), ctx('virtualenv.name'))
-    with cd(get_project_dir()):
-        return sudo('{}/bin/{}'.format(venv_path, i))
+    with span(i, kind='command'), cd(get_release_dir()):
+        return sudo(venv_command(i))
 
 
 def pip(i):
-    venv('pip {}'.format(i))
+    return venv('pip {}'.format(i))
 
 
 def python(i):
@@ -25,3 +63,58 @@ def python(i):
 
 def manage(i):
     return python('manage.py {}'.format(i))
+
+
+def batch(commands):
+    """
+    Runs a list of shell commands from the release directory in a single
+    remote sudo invocation, instead of one session per command. The
+    commands run in order and the batch stops at the first one that fails.
+
+    Returns a (command, return code, output) tuple for each command that
+    ran, aborts if one of them failed.
+    """
+    script = []
+    for index, command in enumerate(commands):
+        script.append(
+            '{command}; s=$?; echo; echo "{marker} {index} $s"; '
+            '[ $s -eq 0 ] || exit $s'.format(
+                command=command, marker=BATCH_MARKER, index=index))
+
+    name = 'batch: {}'.format(', '.join(commands))
+    with span(name, kind='command'), cd(get_release_dir()), \
+            settings(hide('stdout'), warn_only=True):
+        out = sudo('; '.join(script))
+
+    results, lines = [], []
+    for line in out.splitlines():
+        match = BATCH_STATUS.match(line.strip())
+        if match is None:
+            lines.append(line)
+            continue
+        # The marker is preceded by an extra newline
+        output = '\n'.join(lines[:-1] if lines and not lines[-1] else lines)
+        index, status = int(match.group(1)), int(match.group(2))
+        results.append((commands[index], status, output))
+        lines = []
+        if output:
+            print(output)
+
+    if out.failed:
+        if lines:
+            print('\n'.join(lines))
+        if results and results[-1][1]:
+            failed = results[-1][0]
+        else:
+            failed = commands[min(len(results), len(commands) - 1)]
+        abort(red('Batch command failed ({}): {}'.format(
+            out.return_code, failed)))
+    return results
+
+
+def manage_batch(*commands):
+    """
+    Runs several django manage.py commands in a single remote invocation,
+    see batch()
+    """
+    return batch([manage_command(i) for i in commands])
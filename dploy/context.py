@@ -1,24 +1,35 @@
 import os
 import sys
-import yaml
-import collections
+import copy
+import json
+import base64
+import hashlib
 
-from io import BytesIO
-from jinja2 import Template
-
-from fabric.api import env, get
+from fabric.api import env, execute, sudo, settings, hide
 from fabric.utils import abort
-from fabric.colors import red
-from fabric.contrib import files
+from fabric.colors import red, yellow
+
+from dploy import cache
+from dploy.utils import load_yaml, git_dirname, quote
 
-from dploy.utils import load_yaml, git_dirname
+try:
+    from collections.abc import Mapping
+except ImportError:  # Python 2
+    from collections import Mapping
 
 CONTEXT_CACHE = {}
+CONTEXT_DIGESTS = {}
+RESOLVED_CACHE = {}
+TEMPLATE_CACHE = {}
+
+# Maximum number of rendering passes used to resolve templated values that
+# reference other templated values
+MAX_RENDER_PASSES = 10
 
 
 def update(orig_dict, new_dict):
     for key, val in new_dict.items():
-        if isinstance(val, collections.Mapping):
+        if isinstance(val, Mapping):
             tmp = update(orig_dict.get(key, {}), val)
             orig_dict[key] = tmp
         elif isinstance(val, list):
@@ -39,22 +50,126 @@ def get_project_context():
         return context
 
 
-def get_stage_context(project_name, stage):
-    _path = '/root/.context/{project}/{stage}.yml'.format(**{
+def get_stage_context_path(project_name, stage):
+    return '/root/.context/{project}/{stage}.yml'.format(**{
         'project': project_name,
         'stage': stage,
     })
-    if not CONTEXT_CACHE.get(_path):
-        if files.exists(_path, use_sudo=True):
-            fd = BytesIO()
-            get(_path, fd, use_sudo=True)
-            CONTEXT_CACHE[_path] = yaml.load(fd.getvalue())
+
+
+# Prints "unchanged <sha1>" if the remote stage file matches the digest of
+# the local cache, "content <sha1>" followed by the file (base64) otherwise
+FETCH_SCRIPT = (
+    'if [ ! -f {path} ]; then echo missing; else '
+    'd=$(sha1sum < {path} | cut -d " " -f 1); '
+    'if [ "$d" = {digest} ]; then echo "unchanged $d"; '
+    'else echo "content $d"; base64 < {path}; fi; fi')
+
+
+def get_stage_context_key(project_name, stage, host=None):
+    """
+    Returns the CONTEXT_CACHE key of the stage context of a host
+    """
+    if env.get('stage_context_file') is not None:
+        return (None, env.stage_context_file)
+    return (host or env.host_string,
+            get_stage_context_path(project_name, stage))
+
+
+def load_stage_context(key, content):
+    """
+    Parses and stores a stage context
+    """
+    import yaml  # Imported on use, like jinja2 (see dploy.registry)
+    try:
+        context = yaml.safe_load(content) or {}
+    except yaml.YAMLError as e:
+        abort(red('Invalid stage context {} on {}: {}'.format(
+            key[1], key[0], e)))
+    if not isinstance(context, Mapping):
+        abort(red('Invalid stage context {} on {}'.format(key[1], key[0])))
+    CONTEXT_CACHE[key] = context
+    CONTEXT_DIGESTS[key] = hashlib.sha1(content).hexdigest()
+
+
+def _fetch_stage_context(path, digests):
+    with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+        out = sudo(FETCH_SCRIPT.format(
+            path=quote(path),
+            digest=quote(digests.get(env.host_string) or '-')))
+    return str(out)
+
+
+def fetch_stage_contexts(project_name, stage, hosts):
+    """
+    Fetches the stage context of every host at once (in parallel). A host
+    whose file did not change since the last run only sends its digest, the
+    content comes from the local encrypted cache (see dploy.cache). Hosts
+    whose stage context differs from the others are reported.
+    """
+    path = get_stage_context_path(project_name, stage)
+    name = '{}-{}'.format(project_name, stage)
+    # Only the digests whose content is still in the local cache are sent
+    cached, digests = {}, {}
+    for host, digest in cache.get_index(name).items():
+        if digest not in cached:
+            cached[digest] = cache.read(name, digest)
+        if cached[digest] is not None:
+            digests[host] = digest
+    with settings(parallel=len(hosts) > 1):
+        results = execute(_fetch_stage_context, path, digests, hosts=hosts)
+
+    missing = []
+    for host in hosts:
+        out = results.get(host)
+        # Failed hosts send back their exception
+        lines = out.strip().splitlines() if isinstance(out, str) else []
+        tokens = lines[0].split() if lines else ['missing']
+        if tokens[0] == 'unchanged':
+            content = cached[tokens[1]]
+        elif tokens[0] == 'content':
+            content = base64.b64decode(''.join(lines[1:]))
+            digests[host] = cache.write(name, content)
         else:
-            print(red(
-                'ERROR: context file not found: {}, aborting'.format(_path)))
-            sys.exit(1)
-            CONTEXT_CACHE[_path] = {}
-    return CONTEXT_CACHE.get(_path)
+            missing.append(host)
+            continue
+        load_stage_context((host, path), content)
+    cache.save_index(name, digests)
+
+    if missing:
+        print(red('ERROR: context file not found: {} on {}, aborting'.format(
+            path, ', '.join(missing))))
+        sys.exit(1)
+
+    hosts_by_digest = {}
+    for host in hosts:
+        hosts_by_digest.setdefault(digests[host], []).append(host)
+    if len(hosts_by_digest) > 1:
+        common = max(hosts_by_digest.values(), key=len)
+        divergent = [h for h in hosts if h not in common]
+        print(yellow('WARNING: the stage context of {} differs from the '
+                     'one of {}'.format(', '.join(divergent),
+                                        ', '.join(common))))
+
+
+def get_stage_context(project_name, stage):
+    """
+    Returns the stage context stored on the current host, or read from the
+    local env.stage_context_file when it is set (see render). The contexts
+    of all the stage hosts are fetched the first time one is needed.
+    """
+    key = get_stage_context_key(project_name, stage)
+    if key in CONTEXT_CACHE:
+        return CONTEXT_CACHE[key]
+    if key[0] is None:
+        with open(key[1], 'rb') as fd:
+            load_stage_context(key, fd.read())
+    else:
+        hosts = [h for h in env.hosts if (h, key[1]) not in CONTEXT_CACHE]
+        if key[0] not in hosts:
+            hosts.append(key[0])
+        fetch_stage_contexts(project_name, stage, hosts)
+    return CONTEXT_CACHE[key]
 
 
 def get_context():
@@ -62,48 +177,254 @@ def get_context():
     base_context = load_yaml(defaults)
     project_context = get_project_context()
     base_context = update(base_context, project_context.get('global'))
-    # TODO: use get_stage_context
+    # The stage context of the hosts is merged per host, see
+    # get_resolved_context
     base_context = update(base_context,
                           project_context.get('stages').get(env.stage))
     return base_context
 
 
-def ctx(path, default=None, context=None):
+def get_roles():
+    """
+    Returns the roles of the stage: {name: {hosts, phases, context}}
+    """
+    return env.context.get('roles') or {}
+
+
+def get_stage_hosts():
+    """
+    Returns the hosts of the stage and of its roles
+    """
+    hosts = list(env.context.get('hosts') or [])
+    for name, role in sorted(get_roles().items()):
+        hosts.extend(h for h in role.get('hosts') or [] if h not in hosts)
+    return hosts
+
+
+def get_roledefs():
+    return dict((name, list(role.get('hosts') or []))
+                for name, role in get_roles().items())
+
+
+def get_host_roles(host):
+    return sorted(name for name, role in get_roles().items()
+                  if host in (role.get('hosts') or []))
+
+
+def get_host_phases(host):
+    """
+    Returns the phases a host runs (the union of the phases of its roles),
+    None if it runs all of them
+    """
+    phases = set()
+    roles = get_host_roles(host)
+    for name in roles:
+        if get_roles()[name].get('phases') is None:
+            return None
+        phases.update(get_roles()[name]['phases'])
+    return phases if roles else None
+
+
+def get_host_overlays(host):
+    """
+    Returns the context overrides of a host: the ones of its roles, then
+    its own ones (host_context)
+    """
+    overlays = [get_roles()[name].get('context') or {}
+                for name in get_host_roles(host)]
+    overlays.append((env.context.get('host_context') or {}).get(host) or {})
+    return [overlay for overlay in overlays if overlay]
+
+
+def reset_context_cache():
+    """
+    Drops every resolved context, called whenever the stage changes
+    """
+    RESOLVED_CACHE.clear()
+
+
+def is_template(val):
+    return isinstance(val, str) and ('{{' in val or '{%' in val)
+
+
+def render_value(val, context):
+    """
+    Renders a templated string against a context, compiled templates are
+    cached since the same strings are rendered for every host
+    """
+    if not is_template(val):
+        return val
+    template = TEMPLATE_CACHE.get(val)
+    if template is None:
+        from jinja2 import Template
+        template = TEMPLATE_CACHE[val] = Template(val)
+    return template.render(**context)
+
+
+def render_context(context):
+    """
+    Returns a copy of the context where every templated string has been
+    rendered. Values can reference other templated values (ex:
+    `{{ nginx["document_root"] }}`), so rendering is repeated until the
+    context stops changing.
+    """
+    def _render(val, variables):
+        if isinstance(val, Mapping):
+            return dict((k, _render(v, variables)) for k, v in val.items())
+        elif isinstance(val, list):
+            return [_render(v, variables) for v in val]
+        return render_value(val, variables)
+
+    rendered = context
+    for i in range(MAX_RENDER_PASSES):
+        variables = dict(rendered, stage=env.stage)
+        _rendered = _render(rendered, variables)
+        if _rendered == rendered:
+            break
+        rendered = _rendered
+    return rendered
+
+
+def flatten_context(context, prefix='', index=None):
+    """
+    Returns a flat {'dotted.path': value} index of a context
+    """
+    if index is None:
+        index = {}
+    for key, val in context.items():
+        path = '{}{}'.format(prefix, key)
+        index[path] = val
+        if isinstance(val, Mapping):
+            flatten_context(val, '{}.'.format(path), index)
+    return index
+
+
+def compile_context(context):
+    """
+    Returns a (rendered context, flat index) tuple for a context
+    """
+    rendered = render_context(context)
+    return rendered, flatten_context(rendered)
+
+
+def get_resolved_context(overlay=None):
+    """
+    Returns the compiled context of the current stage and host.
+
+    The overrides of the host roles and of the host itself, then the remote
+    stage context, are merged in when running against a host. The result is
+    memoized per (stage, host) and is only rebuilt when the stage changes
+    (see `on`) or when the remote stage file content changes.
+
+    An overlay dict can be given to merge extra values over the context
+    (ex: the context of a template), the result is memoized per overlay
+    content as well.
+    """
+    key = (env.stage, env.host_string)
+    stage_context, digest = None, None
+    if env.host_string:
+        project_name = env.context['django']['project_name']
+        stage_context = get_stage_context(project_name, env.stage)
+        digest = CONTEXT_DIGESTS.get(
+            get_stage_context_key(project_name, env.stage))
+
+    cached = RESOLVED_CACHE.get(key)
+    if cached is None or cached[0] != digest:
+        context = copy.deepcopy(env.context)
+        for host_overlay in get_host_overlays(env.host_string):
+            context = update(context, copy.deepcopy(host_overlay))
+        if stage_context:
+            context = update(context, copy.deepcopy(stage_context))
+        # The contexts compiled with an overlay are memoized next to it
+        cached = RESOLVED_CACHE[key] = (
+            digest, compile_context(context), {})
+
+    if not overlay:
+        return cached[1]
+    overlay_key = json.dumps(overlay, sort_keys=True, default=repr)
+    if overlay_key not in cached[2]:
+        rendered = update(copy.deepcopy(cached[1][0]),
+                          copy.deepcopy(overlay))
+        cached[2][overlay_key] = compile_context(rendered)
+    return cached[2][overlay_key]
+
+
+def lookup(index, path, default=None):
+    """
+    Returns the value of a dotted path from a compiled context index
+    """
     if path == 'stage':
         return env.stage
     elif path == 'base_path':
         return env.base_path
-    context = env.context
-    if env.host_string:
-        context = update(
-            context, get_stage_context(
-                context['django']['project_name'], env.stage))
-    tokens = path.split('.')
-    tokens.reverse()
-    val = env.context
-    while len(tokens):
-        try:
-            val = val.get(tokens.pop())
-            if len(tokens) == 0:
-                break
-        except AttributeError:
-            val = None
-            break
 
+    val = index.get(path)
     if val is None and default is not None:
-        val = default
+        val = render_value(default, dict(env.context, stage=env.stage))
     elif val is None:
         abort(red('Configuration error: {}'.format(path)))
+    return val
 
-    if isinstance(val, str):
-        if context is None:
-            context = env.context
-        context['stage'] = env.stage
-        return Template(val).render(**context)
-    else:
-        return val
+
+def ctx(path, default=None, context=None):
+    """
+    Returns the value of a dotted path (ex: `nginx.server_name`) from the
+    resolved context, `context` is an optional dict merged over it
+    """
+    return lookup(get_resolved_context(context)[1], path, default)
+
+
+def get_dirs():
+    """
+    Returns the directories (`<section>.dirs.*`) of the resolved context,
+    without duplicates
+    """
+    paths = []
+    for section in get_resolved_context()[0].values():
+        if isinstance(section, Mapping) and \
+                isinstance(section.get('dirs'), Mapping):
+            for path in section['dirs'].values():
+                if path and path not in paths:
+                    paths.append(path)
+    return paths
 
 
 def get_project_dir():
     return os.path.join(ctx('nginx.document_root'),
                         git_dirname(ctx('git.repository')))
+
+
+def releases_enabled():
+    return bool(ctx('rollbacks.enabled', default=False))
+
+
+def artifact_enabled():
+    return bool(ctx('artifact.enabled', default=False))
+
+
+def builds_on_hosts():
+    return not artifact_enabled()
+
+
+def get_release_dir():
+    """
+    Returns the directory the code being deployed goes in. With releases
+    enabled and a release in progress (env.release), it is a new directory
+    under rollbacks.dirs.releases, otherwise it is the project directory.
+    """
+    if releases_enabled() and env.get('release'):
+        return os.path.join(ctx('rollbacks.dirs.releases'), env.release)
+    return get_project_dir()
+
+
+def get_venv_path(live=False):
+    """
+    Returns the virtualenv path. With releases enabled each release has its
+    own virtualenv, `live` returns the one of the active release through the
+    project directory symlink.
+    """
+    if releases_enabled():
+        root = get_project_dir() if live else get_release_dir()
+    else:
+        root = ctx('virtualenv.dirs.root')
+    return os.path.join(root, ctx('virtualenv.name'))
@@ -0,0 +1,192 @@
+"""
+Remote facts: the existence of paths and packages a deploy asks about, and
+the resources (cpus, memory) of the host.
+
+Instead of one SSH round-trip per `files.exists` or `deb.is_installed`
+call, every fact a deploy is known to need is probed with a single remote
+command the first time one of them is requested on a host. The answers are
+cached in the host state for the rest of the run.
+"""
+import os
+
+from fabric.api import sudo, hide, settings
+
+from dploy.context import ctx, get_project_dir, get_release_dir
+from dploy.utils import host_state, quote
+from dploy.trace import span
+
+LETSENCRYPT_LIVE = '/etc/letsencrypt/live'
+LETSENCRYPT_DHPARAMS = '/etc/letsencrypt/ssl-dhparams.pem'
+LETSENCRYPT_OPTIONS = '/etc/letsencrypt/options-ssl-nginx.conf'
+
+PACKAGES = [
+    'git',
+    'supervisor',
+    'python-virtualenv',
+    'certbot',
+]
+
+
+def get_expected_paths():
+    """
+    Returns the paths that deploy tasks check on a host
+    """
+    project_dir = get_project_dir()
+    release_dir = get_release_dir()
+    server_name = ctx('nginx.server_name')
+    paths = [
+        project_dir,
+        os.path.join(release_dir, 'requirements.pip'),
+        os.path.join(release_dir, 'requirements.txt'),
+        ctx('nginx.document_root'),
+        LETSENCRYPT_DHPARAMS,
+        LETSENCRYPT_OPTIONS,
+        '{}/{}/fullchain.pem'.format(LETSENCRYPT_LIVE, server_name),
+    ]
+    for key in ('ssl.key', 'ssl.cert', 'ssl.dhparam'):
+        path = ctx(key, default=False)
+        if path:
+            paths.append(path)
+    return paths
+
+
+RESOURCES_SCRIPT = (
+    'echo "resource cpus $(nproc)"; '
+    'echo "resource memory $(awk \'/^MemTotal:/ {print int($2 / 1024)}\' '
+    '/proc/meminfo)"; '
+    'echo "resource somaxconn $(cat /proc/sys/net/core/somaxconn)"')
+
+
+def probe(paths=(), packages=(), resources=False):
+    """
+    Checks a list of paths and packages (and the host resources) on the
+    current host using a single remote command and stores the results in
+    the host facts
+    """
+    facts = host_state('facts')
+    facts.setdefault('paths', {})
+    facts.setdefault('packages', {})
+    script = []
+    if resources:
+        script.append(RESOURCES_SCRIPT)
+    if paths:
+        script.append(
+            'for p in {}; do if [ -e "$p" ]; then echo "path 1 $p"; '
+            'else echo "path 0 $p"; fi; done'.format(
+                ' '.join(map(quote, paths))))
+    if packages:
+        script.append(
+            "dpkg-query -W -f='package ${{Status}} ${{Package}}\\n' "
+            "{} 2>/dev/null".format(' '.join(map(quote, packages))))
+    script.append('true')
+
+    with span('facts.probe', kind='command'), \
+            settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+        out = sudo('; '.join(script))
+
+    for package in packages:
+        facts['packages'][package] = False
+    for line in out.splitlines():
+        tokens = line.strip().split(' ')
+        if tokens[0] == 'path' and len(tokens) >= 3:
+            facts['paths'][' '.join(tokens[2:])] = tokens[1] == '1'
+        elif tokens[0] == 'package' and len(tokens) >= 2:
+            facts['packages'][tokens[-1]] = 'installed' in tokens[1:-1]
+        elif tokens[0] == 'resource' and len(tokens) == 3 and \
+                tokens[2].isdigit():
+            facts.setdefault('resources', {})[tokens[1]] = int(tokens[2])
+    return facts
+
+
+def get_facts():
+    """
+    Returns the facts of the current host, probing every expected path and
+    package the first time
+    """
+    facts = host_state('facts')
+    if not facts.get('probed'):
+        probe(get_expected_paths(), PACKAGES,
+              resources='resources' not in facts)
+        facts['probed'] = True
+    return facts
+
+
+def exists(path):
+    """
+    Cached equivalent of `files.exists(path, use_sudo=True)`
+    """
+    facts = get_facts()
+    if path not in facts['paths']:
+        probe(paths=[path])
+    return facts['paths'][path]
+
+
+def is_installed(package):
+    """
+    Cached equivalent of `fabtools.deb.is_installed(package)`
+    """
+    facts = get_facts()
+    if package not in facts['packages']:
+        probe(packages=[package])
+    return facts['packages'][package]
+
+
+def get_resources():
+    """
+    Returns the {cpus, memory (MB), somaxconn} resources of the host, the
+    ones that could not be probed are missing
+    """
+    facts = get_facts()
+    if 'resources' not in facts:
+        probe(resources=True)
+    return facts.setdefault('resources', {})
+
+
+def set_path(path, exists=True):
+    """
+    Records that a path was created (or removed) by a task
+    """
+    host_state('facts').setdefault('paths', {})[path] = exists
+
+
+def set_installed(*packages):
+    """
+    Records that packages were installed by a task
+    """
+    facts = host_state('facts').setdefault('packages', {})
+    for package in packages:
+        facts[package] = True
+
+
+def forget(prefix=None):
+    """
+    Drops the cached paths under `prefix` (all paths if None) so they are
+    probed again on their next lookup
+    """
+    facts = host_state('facts')
+    facts['probed'] = False
+    paths = facts.setdefault('paths', {})
+    for path in list(paths):
+        if prefix is None or path == prefix or \
+                path.startswith(prefix.rstrip('/') + '/'):
+            del paths[path]
+
+
+def forget_packages():
+    """
+    Drops the cached packages, used after installing arbitrary packages
+    """
+    facts = host_state('facts')
+    facts['probed'] = False
+    facts['packages'] = {}
+
+
+def require_packages(*packages):
+    """
+    Installs the packages that are not installed yet with a single apt call
+    """
+    missing = [p for p in packages if not is_installed(p)]
+    if missing:
+        import fabtools  # Imported on use (see dploy.registry)
+        fabtools.deb.install(missing)
+        set_installed(*missing)
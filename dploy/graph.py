@@ -0,0 +1,75 @@
+"""
+Deploy graph: each deploy phase (a task name) declares the resources it
+requires and provides (ex: 'code', 'venv', 'settings'). Phases are grouped
+in waves, a phase only waits for the phases providing what it requires so
+independent phases can run at the same time.
+"""
+from collections import OrderedDict
+
+from fabric.utils import abort
+from fabric.colors import red
+
+PHASES = OrderedDict()
+
+
+def register_phase(name, requires=(), provides=(), leader=False, when=None,
+                   rolling=False):
+    """
+    Adds a phase to the deploy graph, or replaces it.
+
+    Requirements that no phase provides are ignored. `leader` phases run
+    on a single host per stage, `rolling` phases can run on a few hosts at
+    a time (deploy.rolling) and `when` is an optional callable telling
+    whether the phase is part of the current deploy.
+    """
+    PHASES[name] = {
+        'name': name,
+        'requires': list(requires),
+        'provides': list(provides),
+        'leader': leader,
+        'rolling': rolling,
+        'when': when,
+    }
+
+
+def unregister_phase(name):
+    PHASES.pop(name, None)
+
+
+def get_phases():
+    """
+    Returns the phases that are part of the current deploy
+    """
+    return [p for p in PHASES.values() if p['when'] is None or p['when']()]
+
+
+def get_waves(phases=None):
+    """
+    Returns the phase names grouped in waves, a wave only depends on the
+    phases of the previous waves. Phases keep their registration order
+    within a wave.
+    """
+    phases = get_phases() if phases is None else phases
+    providers = {}
+    for phase in phases:
+        for resource in phase['provides']:
+            providers.setdefault(resource, set()).add(phase['name'])
+
+    dependencies = {}
+    for phase in phases:
+        dependencies[phase['name']] = set(
+            name for resource in phase['requires']
+            for name in providers.get(resource, ())
+            if name != phase['name'])
+
+    waves, done = [], set()
+    remaining = [phase['name'] for phase in phases]
+    while remaining:
+        wave = [name for name in remaining if dependencies[name] <= done]
+        if not wave:
+            abort(red('Circular dependency between phases: {}'.format(
+                ', '.join(remaining))))
+        waves.append(wave)
+        done.update(wave)
+        remaining = [name for name in remaining if name not in done]
+    return waves
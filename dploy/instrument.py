@@ -0,0 +1,101 @@
+"""
+Round-trip instrumentation of the Fabric operations.
+
+Every remote command (run, sudo, and everything built on them: files.exists,
+fabtools helpers, ...) and every SFTP transfer (put, get) is a round-trip to
+a host. Once installed, each of them is recorded as a span (see
+dploy.trace) named after its call site, the first frame outside of Fabric,
+fabtools and this module (ex: dploy/tasks/nginx.py:42), with the task it
+was made for, its latency and the bytes sent and received.
+"""
+import os
+import sys
+import functools
+
+import fabric.operations
+import fabric.sftp
+
+from dploy.trace import span
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Frames from these files are skipped when looking for the call site
+SKIPPED = (
+    os.path.dirname(fabric.operations.__file__) + os.sep,
+    '{0}fabtools{0}'.format(os.sep),
+    os.path.splitext(__file__)[0],
+    os.path.splitext(functools.__file__)[0],
+    'contextlib',
+)
+# Length of the commands kept in the spans
+COMMAND_LENGTH = 200
+
+_originals = {}
+
+
+def get_call_site():
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if not any(s in filename for s in SKIPPED):
+            if filename.startswith(ROOT_DIR + os.sep):
+                filename = filename[len(ROOT_DIR) + 1:]
+            return '{}:{}'.format(filename, frame.f_lineno)
+        frame = frame.f_back
+    return '<unknown>'
+
+
+def get_size(path_or_fd):
+    """
+    Returns the size of a local file, given its path or a file object
+    """
+    try:
+        if hasattr(path_or_fd, 'seek'):
+            position = path_or_fd.tell()
+            path_or_fd.seek(0, os.SEEK_END)
+            size = path_or_fd.tell()
+            path_or_fd.seek(position)
+            return size
+        return os.path.getsize(os.path.expanduser(path_or_fd))
+    except (IOError, OSError, TypeError, ValueError):
+        return 0
+
+
+def run_command(command, *args, **kwargs):
+    with span(get_call_site(), kind='exec') as record:
+        record['command'] = command[:COMMAND_LENGTH]
+        out = _originals['run_command'](command, *args, **kwargs)
+        record['bytes'] = len(command) + len(out) + \
+            len(getattr(out, 'stderr', '') or '')
+        return out
+
+
+def sftp_put(self, local_path, remote_path, *args, **kwargs):
+    with span(get_call_site(), kind='transfer') as record:
+        record['command'] = 'put {}'.format(remote_path)
+        result = _originals['put'](self, local_path, remote_path, *args,
+                                   **kwargs)
+        record['bytes'] = get_size(local_path)
+        return result
+
+
+def sftp_get(self, remote_path, local_path, *args, **kwargs):
+    with span(get_call_site(), kind='transfer') as record:
+        record['command'] = 'get {}'.format(remote_path)
+        result = _originals['get'](self, remote_path, local_path, *args,
+                                   **kwargs)
+        record['bytes'] = get_size(result)
+        return result
+
+
+def install():
+    """
+    Wraps the Fabric operations, only once
+    """
+    if _originals:
+        return
+    _originals['run_command'] = fabric.operations._run_command
+    _originals['put'] = fabric.sftp.SFTP.put
+    _originals['get'] = fabric.sftp.SFTP.get
+    fabric.operations._run_command = run_command
+    fabric.sftp.SFTP.put = sftp_put
+    fabric.sftp.SFTP.get = sftp_get
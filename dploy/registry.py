@@ -0,0 +1,97 @@
+"""
+Lazy registry of the dploy task modules.
+
+fab walks the fabfile namespace to list and resolve tasks, which used to
+import every task module (and fabtools with them) even for `fab -l` or a
+single task. Task modules are instead parsed (ast) for their @task
+functions and exposed as stub modules of LazyTask objects holding their
+name and docstring, a module is only imported when one of its tasks (or
+another of its attributes) is used.
+"""
+import os
+import ast
+import types
+import importlib
+
+from fabric.tasks import Task
+
+TASKS_PACKAGE = 'dploy.tasks'
+TASKS_DIR = os.path.join(os.path.dirname(__file__), 'tasks')
+
+
+def load_module(name):
+    """
+    Imports a task module (ex: django)
+    """
+    return importlib.import_module('{}.{}'.format(TASKS_PACKAGE, name))
+
+
+def is_task_decorator(node):
+    if isinstance(node, ast.Call):
+        node = node.func
+    if isinstance(node, ast.Attribute):
+        return node.attr == 'task'
+    return isinstance(node, ast.Name) and node.id == 'task'
+
+
+def parse_tasks(name):
+    """
+    Returns the (name, docstring) of the @task functions of a task module,
+    without importing it
+    """
+    path = os.path.join(TASKS_DIR, '{}.py'.format(name))
+    with open(path, 'r') as fd:
+        tree = ast.parse(fd.read(), path)
+    return [(node.name, ast.get_docstring(node, clean=False))
+            for node in tree.body
+            if isinstance(node, ast.FunctionDef) and
+            any(is_task_decorator(d) for d in node.decorator_list)]
+
+
+class LazyTask(Task):
+    """
+    Stands for a task until it runs, the attributes it does not know about
+    (ex: parallel, pool_size) are read from the real task
+    """
+    def __init__(self, module, name, doc):
+        super(LazyTask, self).__init__(name=name)
+        self.module = module
+        self.__doc__ = doc
+
+    def load(self):
+        return getattr(load_module(self.module), self.name)
+
+    def __getattr__(self, attr):
+        if attr.startswith('__') or attr in ('module', 'name'):
+            raise AttributeError(attr)
+        return getattr(self.load(), attr)
+
+    def __details__(self):
+        return self.load().__details__()
+
+    def __call__(self, *args, **kwargs):
+        return self.load()(*args, **kwargs)
+
+    def run(self, *args, **kwargs):
+        return self.load().run(*args, **kwargs)
+
+
+class LazyModule(types.ModuleType):
+    """
+    Stub of a task module, its other attributes (ex: get_templates) import
+    the real module
+    """
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        return getattr(load_module(self.__name__.rsplit('.', 1)[-1]), attr)
+
+
+def lazy_module(name):
+    """
+    Returns the stub of a task module (ex: django)
+    """
+    module = LazyModule('{}.{}'.format(TASKS_PACKAGE, name))
+    for task_name, doc in parse_tasks(name):
+        setattr(module, task_name, LazyTask(name, task_name, doc))
+    return module
@@ -0,0 +1,109 @@
+"""
+Local rendering of the config files uploaded by the deploy tasks.
+
+Tasks register a function returning the (template, remote path, upload
+options) of their config files, they are rendered with the same lookup
+rules and context as upload_template, without connecting to the hosts.
+"""
+import os
+import difflib
+
+from collections import OrderedDict
+
+from fabric.api import env, settings
+from fabric.colors import cyan, green, red, yellow
+
+from dploy.utils import render_upload
+
+TEMPLATES = OrderedDict()
+
+
+def register_templates(name, func):
+    """
+    Registers the function returning the config files of a task (name)
+    """
+    TEMPLATES[name] = func
+
+
+def get_output_path(output, host, path):
+    return os.path.join(output, env.stage, host or 'localhost',
+                        path.lstrip('/'))
+
+
+def read(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as fd:
+        return fd.read()
+
+
+def render_host(output, host):
+    """
+    Renders the config files of a host, returns {local path: content}
+    """
+    rendered = OrderedDict()
+    with settings(host_string=host):
+        for name, func in TEMPLATES.items():
+            for template, path, options in func():
+                content = render_upload(template, **options)
+                if content is not None:
+                    rendered[get_output_path(output, host, path)] = content
+    return rendered
+
+
+def render(output, hosts):
+    """
+    Renders the config files of every host in output/<stage>/<host>/ and
+    prints the differences with the previous render. Returns the list of
+    (local path, status) that changed, status being one of added, modified
+    or removed.
+    """
+    root = os.path.join(output, env.stage)
+    previous = set()
+    for dirpath, dirnames, filenames in os.walk(root):
+        previous.update(os.path.join(dirpath, f) for f in filenames)
+
+    rendered = OrderedDict()
+    for host in hosts or [None]:
+        rendered.update(render_host(output, host))
+
+    changes = []
+    for path, content in rendered.items():
+        old = read(path)
+        if old == content:
+            continue
+        changes.append((path, 'added' if old is None else 'modified'))
+        print_diff(path, old, content)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as fd:
+            fd.write(content)
+
+    for path in sorted(previous - set(rendered)):
+        changes.append((path, 'removed'))
+        print_diff(path, read(path), None)
+        os.remove(path)
+    return changes
+
+
+def print_diff(path, old, new):
+    old = (old or b'').decode('utf-8').splitlines(True)
+    new = (new or b'').decode('utf-8').splitlines(True)
+    for line in difflib.unified_diff(old, new, path, path):
+        if line.startswith('+') and not line.startswith('+++'):
+            print(green(line.rstrip('\n')))
+        elif line.startswith('-') and not line.startswith('---'):
+            print(red(line.rstrip('\n')))
+        elif line.startswith('@@'):
+            print(cyan(line.rstrip('\n')))
+        else:
+            print(line.rstrip('\n'))
+
+
+def print_changes(changes, rendered_hosts):
+    if not changes:
+        print(green('No changes for {} ({} host(s))'.format(
+            env.stage, rendered_hosts)))
+        return
+    for path, status in changes:
+        print(yellow('  {:<10} {}'.format(status, path)))
@@ -0,0 +1,206 @@
+import time
+import multiprocessing
+
+from fabric.api import env, execute, settings
+from fabric.colors import cyan, green, red
+from fabric.network import ssh, normalize_to_string
+from fabric.state import connections
+
+from dploy.utils import FabricException, HOST_STATE
+from dploy.trace import span
+
+
+def run_phase(name, *args, **kwargs):
+    """
+    Runs a task on the current host only and returns an (error, state)
+    tuple, where error is the error message if it failed (None otherwise)
+    and state is the host state, so it survives parallel runs.
+
+    The host list is narrowed to the current host so tasks that execute()
+    other tasks (ex: django.setup) do not fan out on the whole stage again.
+    """
+    error = None
+    hosts = [env.host_string] if env.host_string else []
+    with settings(hosts=hosts, parallel=False, phase=name):
+        try:
+            with span(name, kind='phase'):
+                execute(name, *args, hosts=hosts, **kwargs)
+        except (FabricException, SystemExit) as e:
+            error = str(e) or e.__class__.__name__
+        except Exception as e:
+            # Reported as a failure of the host like aborts, instead of
+            # stopping the whole run (ex: NetworkError, KeyError)
+            error = '{}: {}'.format(e.__class__.__name__, e)
+    return error, HOST_STATE.get(env.host_string)
+
+
+def merge_state(orig, new):
+    """
+    Merges the host state sent back by a job into the current one
+    """
+    for key, val in new.items():
+        if isinstance(val, dict) and isinstance(orig.get(key), dict):
+            merge_state(orig[key], val)
+        else:
+            orig[key] = val
+    return orig
+
+
+def _run_job(queue, index, phase, host, kwargs):
+    # The SSH connection of the parent process cannot be shared
+    connections.pop(normalize_to_string(host), None)
+    with settings(parallel=False):
+        results = execute(run_phase, phase, hosts=[host], **kwargs)
+    queue.put((index, results[host]))
+
+
+def run_jobs(jobs, parallel=False, pool_size=None):
+    """
+    Runs a list of (phase, host, kwargs) jobs, at most `pool_size` at once
+    in separate processes with `parallel` enabled, one after the other
+    otherwise. Returns the (error, state) result of each job.
+    """
+    if not parallel or len(jobs) < 2:
+        results = []
+        for phase, host, kwargs in jobs:
+            rs = execute(run_phase, phase, hosts=[host] if host else [],
+                         **kwargs)
+            results.append(list(rs.values())[0])
+        return results
+
+    queue = multiprocessing.Queue()
+    pool_size = min(int(pool_size or len(jobs)), len(jobs))
+    pending = list(enumerate(jobs))
+    running = {}
+    results = [None] * len(jobs)
+
+    def _collect():
+        while not queue.empty():
+            index, result = queue.get()
+            results[index] = result
+
+    while pending or running:
+        while pending and len(running) < pool_size:
+            index, (phase, host, kwargs) = pending.pop(0)
+            process = multiprocessing.Process(
+                target=_run_job, args=(queue, index, phase, host, kwargs))
+            process.start()
+            running[index] = process
+        _collect()
+        for index, process in list(running.items()):
+            if not process.is_alive():
+                process.join()
+                del running[index]
+        time.sleep(ssh.io_sleep)
+    _collect()
+
+    for index, (phase, host, kwargs) in enumerate(jobs):
+        if results[index] is None:
+            results[index] = ('Job exited unexpectedly', None)
+    return results
+
+
+def collect_results(jobs, results, failures):
+    """
+    Merges the state sent back by jobs and records their failures, returns
+    True if they all succeeded
+    """
+    ok = True
+    for (phase, host, kwargs), (error, state) in zip(jobs, results):
+        if state is not None:
+            merge_state(HOST_STATE.setdefault(host, {}), state)
+        if error is not None:
+            print(red('{} failed on {}: {}'.format(
+                phase, host or '<local-only>', error)))
+            failures.setdefault(host, (phase, error))
+            ok = False
+    return ok
+
+
+def run_rolling(phase, hosts, batch_size, kwargs, failures, **options):
+    """
+    Runs a phase on `batch_size` hosts at a time. The rollout stops at the
+    first batch that fails, the remaining hosts are reported as failed.
+    """
+    for i in range(0, len(hosts), batch_size):
+        jobs = [(phase, host, kwargs) for host in hosts[i:i + batch_size]]
+        results = run_jobs(jobs, **options)
+        if not collect_results(jobs, results, failures):
+            for host in hosts[i + batch_size:]:
+                failures.setdefault(host, (phase, 'Rollout stopped'))
+            return
+
+
+def run_waves(waves, hosts=None, leader_phases=(), rolling_phases=None,
+              host_phases=None, phase_kwargs=None, parallel=False,
+              pool_size=None):
+    """
+    Runs waves (lists) of tasks (phases) in order on all hosts.
+
+    Each wave acts as a barrier: it must be done on every host before the
+    next one starts. With `parallel` enabled, all the phases of a wave run
+    concurrently on all hosts, at most `pool_size` jobs at once.
+
+    Phases listed in `leader_phases` run once per stage, on the first host
+    that is still healthy. Phases of the `rolling_phases` {phase: batch
+    size} dict run after the other phases of their wave, one batch of hosts
+    at a time. `host_phases` is a {host: phases} dict of the only phases
+    some hosts run (ex: their role). A host on which a phase fails is
+    skipped for the remaining waves instead of aborting the whole run.
+
+    Returns a {host: (phase, error)} dict of failures.
+    """
+    hosts = list(env.hosts if hosts is None else hosts) or [None]
+    parallel = parallel and hosts != [None]
+    rolling_phases = rolling_phases or {}
+    host_phases = host_phases or {}
+    phase_kwargs = phase_kwargs or {}
+    options = {'parallel': parallel, 'pool_size': pool_size}
+    failures = {}
+
+    for wave in waves:
+        live_hosts = [h for h in hosts if h not in failures]
+        if not live_hosts:
+            break
+        phase_hosts = dict((phase, [
+            h for h in live_hosts if host_phases.get(h) is None or
+            phase in host_phases[h]]) for phase in wave)
+        jobs = []
+        for phase in wave:
+            if phase in rolling_phases:
+                continue
+            for host in phase_hosts[phase][:1] if phase in leader_phases \
+                    else phase_hosts[phase]:
+                jobs.append((phase, host, phase_kwargs.get(phase, {})))
+        collect_results(jobs, run_jobs(jobs, **options), failures)
+
+        for phase in wave:
+            if phase in rolling_phases:
+                run_rolling(phase,
+                            [h for h in phase_hosts[phase]
+                             if h not in failures],
+                            int(rolling_phases[phase]),
+                            phase_kwargs.get(phase, {}), failures, **options)
+
+    return failures
+
+
+def run_phases(phases, **kwargs):
+    """
+    Runs a list of tasks (phases) in order on all hosts, see run_waves
+    """
+    return run_waves([[phase] for phase in phases], **kwargs)
+
+
+def print_report(hosts, failures):
+    """
+    Prints the per-host outcome of a run_waves call
+    """
+    print(cyan('Deploy report for {}'.format(env.stage), bold=True))
+    for host in hosts or [None]:
+        if host in failures:
+            phase, error = failures[host]
+            print(red('  {:<40} failed at {}: {}'.format(
+                host or '<local-only>', phase, error)))
+        else:
+            print(green('  {:<40} ok'.format(host or '<local-only>')))
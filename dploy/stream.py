@@ -0,0 +1,142 @@
+"""
+Streams the input/output of remote commands over their SSH channel, without
+going through a remote temporary file.
+
+The commands run as root (sudo -n: it must not ask for a password) with
+bash -o pipefail, from the release directory.
+"""
+import sys
+import time
+import zlib
+
+from fabric.api import env
+from fabric.colors import red
+from fabric.network import ssh
+from fabric.state import connections
+from fabric.utils import abort
+
+from dploy.context import get_release_dir
+from dploy.trace import span
+from dploy.utils import quote
+
+BUFFER_SIZE = 65536
+PROGRESS_INTERVAL = 0.5
+
+
+def gzip_compressor():
+    return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def gzip_decompressor():
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+def open_channel(command):
+    """
+    Starts a command on the current host and returns its channel
+    """
+    command = 'cd {} && {}'.format(quote(get_release_dir()), command)
+    command = 'bash -o pipefail -c {}'.format(quote(command))
+    if env.user != 'root':
+        command = 'sudo -n {}'.format(command)
+    channel = connections[env.host_string].get_transport().open_session()
+    channel.exec_command(command)
+    return channel
+
+
+def print_progress(label, size, start, shown=0, force=False):
+    """
+    Prints the transferred size at most every PROGRESS_INTERVAL seconds,
+    returns the time it was last printed
+    """
+    now = time.time()
+    if not force and now - shown < PROGRESS_INTERVAL:
+        return shown
+    sys.stdout.write('\r{}: {:.1f} MB ({:.1f} MB/s)'.format(
+        label, size / 1048576.0,
+        size / 1048576.0 / max(now - start, 0.001)))
+    sys.stdout.flush()
+    return now
+
+
+def wait(channel, label, errors):
+    status = channel.recv_exit_status()
+    while channel.recv_stderr_ready():
+        errors.append(channel.recv_stderr(BUFFER_SIZE))
+    channel.close()
+    if status != 0:
+        abort(red('{} failed ({}): {}'.format(
+            label, status, b''.join(errors).decode('utf-8', 'replace'))))
+
+
+def stream_out(command, fd, label, decompress=False):
+    """
+    Writes the output of a remote command to a local file object as it is
+    received, decompressing it (gzip) if `decompress` is set. Returns the
+    number of bytes received.
+    """
+    decompressor = gzip_decompressor() if decompress else None
+    received, errors, start, shown = 0, [], time.time(), 0
+    with span(label, kind='transfer') as record:
+        channel = open_channel(command)
+        while True:
+            if channel.recv_ready():
+                data = channel.recv(BUFFER_SIZE)
+            elif channel.recv_stderr_ready():
+                errors.append(channel.recv_stderr(BUFFER_SIZE))
+                continue
+            elif channel.exit_status_ready():
+                data = channel.recv(BUFFER_SIZE)
+                if not data:
+                    break
+            else:
+                time.sleep(ssh.io_sleep)
+                continue
+            received += len(data)
+            fd.write(decompressor.decompress(data) if decompressor else data)
+            shown = print_progress(label, received, start, shown)
+        if decompressor:
+            fd.write(decompressor.flush())
+        print_progress(label, received, start, force=True)
+        print('')
+        record['bytes'] = received
+        wait(channel, label, errors)
+    return received
+
+
+def stream_in(command, fd, label, compress=False):
+    """
+    Sends a local file object to the input of a remote command, compressing
+    it (gzip) if `compress` is set. Returns the number of bytes sent.
+    """
+    compressor = gzip_compressor() if compress else None
+    sent, errors, start, shown = 0, [], time.time(), 0
+    with span(label, kind='transfer') as record:
+        channel = open_channel(command)
+        while True:
+            data = fd.read(BUFFER_SIZE)
+            if compressor and data:
+                data = compressor.compress(data)
+            elif compressor:
+                data, compressor = compressor.flush(), None
+            elif not data:
+                break
+            channel.sendall(data)
+            sent += len(data)
+            shown = print_progress(label, sent, start, shown)
+        channel.shutdown_write()
+        print_progress(label, sent, start, force=True)
+        print('')
+        record['bytes'] = sent
+        output = []
+        while not channel.exit_status_ready() or channel.recv_ready():
+            if channel.recv_ready():
+                output.append(channel.recv(BUFFER_SIZE))
+            elif channel.recv_stderr_ready():
+                errors.append(channel.recv_stderr(BUFFER_SIZE))
+            else:
+                time.sleep(ssh.io_sleep)
+        if output:
+            print(b''.join(output).decode('utf-8', 'replace').rstrip())
+        wait(channel, label, errors)
+    return sent
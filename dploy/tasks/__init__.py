@@ -1,18 +1,96 @@
+import os
+
 from fabric.colors import *  # noqa
 from fabric.api import *  # noqa
 
-from dploy.context import get_context
+from dploy.context import (
+    ctx, get_context, reset_context_cache, releases_enabled, artifact_enabled,
+    builds_on_hosts, get_stage_hosts, get_roledefs, get_host_phases,
+)
+from dploy.graph import (  # noqa
+    PHASES, register_phase, get_phases, get_waves,
+)
+from dploy.runner import run_waves, print_report
+from dploy.trace import save as save_trace, print_summary as print_trace
+from dploy.instrument import install as install_instrumentation
+from dploy.render import (  # noqa
+    register_templates, render as render_templates, print_changes,
+)
 from dploy.commands import pip, manage  # noqa
-from dploy.tasks import django  # noqa
-from dploy.tasks import virtualenv # noqa
-from dploy.tasks import letsencrypt # noqa
-from dploy.tasks import cron  # noqa
-from dploy.tasks import supervisor  # noqa
-from dploy.tasks import uwsgi  # noqa
-from dploy.tasks import nginx  # noqa
-from dploy.tasks import system # noqa
-from dploy.tasks import git  # noqa
-from dploy.tasks import context  # noqa
+from dploy.registry import lazy_module
+from dploy.utils import runs_once_per_stage
+
+# Every remote command and transfer is recorded in the trace, with its call
+# site and the task it was made for (see dploy.instrument)
+install_instrumentation()
+
+# Task modules are only imported when one of their tasks runs (see
+# dploy.registry), so listing tasks or running one of them stays fast
+django = lazy_module('django')
+virtualenv = lazy_module('virtualenv')
+letsencrypt = lazy_module('letsencrypt')
+cron = lazy_module('cron')
+supervisor = lazy_module('supervisor')
+uwsgi = lazy_module('uwsgi')
+nginx = lazy_module('nginx')
+system = lazy_module('system')
+git = lazy_module('git')
+context = lazy_module('context')
+artifact = lazy_module('artifact')
+database = lazy_module('database')
+releases = lazy_module('releases')
+trace = lazy_module('trace')
+
+# Deploy graph, phases run as soon as the phases providing what they require
+# are done (see dploy.graph), project fabfiles can register their own phases
+register_phase('system.setup', provides=['dirs', 'packages'])
+register_phase('git.checkout', requires=['dirs', 'packages'],
+               provides=['code'], when=builds_on_hosts)
+register_phase('virtualenv.setup', requires=['code'], provides=['venv'],
+               when=builds_on_hosts)
+# With artifact enabled, the code, virtualenv and static files are built on
+# the first host only and shipped to the others
+register_phase('artifact.build', requires=['dirs', 'packages'],
+               provides=['artifact'], leader=True, when=artifact_enabled)
+register_phase('artifact.ship', requires=['artifact'],
+               provides=['code', 'venv', 'static'], when=artifact_enabled)
+register_phase('django.setup_settings', requires=['code'],
+               provides=['settings'])
+register_phase('django.migrate', requires=['venv', 'settings'],
+               provides=['database'], leader=True)
+register_phase('django.collectstatic', requires=['venv', 'settings'],
+               provides=['static'], when=builds_on_hosts)
+register_phase('django.setup_log_files_owner', requires=['venv', 'settings'])
+register_phase('cron.setup', requires=['dirs'], provides=['cron'])
+register_phase('uwsgi.setup', requires=['code'], provides=['uwsgi'])
+register_phase('system.set_owner',
+               requires=['code', 'venv', 'settings', 'static'],
+               provides=['owner'])
+# With releases enabled, the new release is activated once it is complete:
+# code, virtualenv, settings, static files, uwsgi.ini, owner and database
+register_phase('releases.activate',
+               requires=['code', 'venv', 'settings', 'static', 'database',
+                         'uwsgi', 'owner'],
+               provides=['live'], when=releases_enabled)
+register_phase('supervisor.setup',
+               requires=['uwsgi', 'venv', 'settings', 'database', 'static',
+                         'owner', 'live'],
+               provides=['app'])
+register_phase('nginx.setup', requires=['dirs'], provides=['nginx'])
+register_phase('uwsgi.restart', requires=['app', 'nginx'],
+               provides=['restart'], rolling=True)
+register_phase('releases.prune', requires=['app', 'nginx', 'restart'],
+               when=releases_enabled)
+
+# Config files rendered locally by the render task, ssl files are assumed to
+# exist and the uwsgi profile is computed from render.resources
+register_templates('django.setup_settings', lambda: django.get_templates())
+register_templates('cron.setup', lambda: cron.get_templates())
+register_templates('uwsgi.setup', lambda: uwsgi.get_templates(
+    ctx('render.resources', default={})))
+register_templates('supervisor.setup', lambda: supervisor.get_templates())
+register_templates('nginx.setup', lambda: nginx.get_templates(
+    exists=lambda path: True))
 
 
 @task
@@ -23,27 +101,76 @@ def on(stage):
     localhosts = ['localhost', '127.0.0.1']
     env.stage = stage
     env.context = get_context()
-    hosts = env.context['hosts']
+    reset_context_cache()
+    hosts = get_stage_hosts()
     if stage == 'dev' and len(hosts) == 1 and hosts[0] in localhosts:
         env.hosts = []
     else:
-        env.hosts = env.context['hosts']
+        env.hosts = hosts
+    env.roledefs = get_roledefs()
 
 
 @task
-def deploy(upgrade=False):
+@runs_once_per_stage
+def deploy(upgrade=False, parallel=None, pool_size=None):
     """
-    Perform all deployment tasks sequentially
+    Perform all deployment tasks, on many hosts at once and independent
+    tasks concurrently with parallel=1
     """
+    if parallel is None:
+        parallel = ctx('deploy.parallel', default=False)
+    else:
+        parallel = parallel in (True, 'True', 'true', '1', 'yes')
+    if pool_size is None:
+        pool_size = ctx('deploy.pool_size', default=False) or None
+    rolling_phases = {}
+    if ctx('deploy.rolling.enabled', default=False):
+        rolling_phases = dict(
+            (p['name'], ctx('deploy.rolling.batch_size'))
+            for p in get_phases() if p['rolling'])
+    host_phases = dict((host, get_host_phases(host)) for host in env.hosts)
+    names = set(p['name'] for p in PHASES.values())
+    for host, phases in host_phases.items():
+        if phases and phases - names:
+            abort(red('Unknown phase(s) in the roles of {}: {}'.format(
+                host, ', '.join(sorted(phases - names)))))
     print("Deploying project on {} !".format(env.stage))
-    execute('system.setup')
-    execute('git.checkout')
-    execute('virtualenv.setup')
-    execute('django.setup')
-    execute('cron.setup')
-    execute('uwsgi.setup')
-    execute('supervisor.setup')
-    execute('nginx.setup')
+    if releases_enabled():
+        releases.create()
+    failures = run_waves(
+        get_waves(),
+        leader_phases=[p['name'] for p in get_phases() if p['leader']],
+        rolling_phases=rolling_phases, host_phases=host_phases,
+        phase_kwargs={
+            'virtualenv.setup': {'upgrade': upgrade},
+            'artifact.build': {'upgrade': upgrade, 'targets': [
+                host for host in env.hosts if not host_phases.get(host) or
+                'artifact.ship' in host_phases[host]]},
+        },
+        parallel=parallel, pool_size=pool_size and int(pool_size))
+    print_trace()
+    if ctx('trace.path', default=False):
+        save_trace(ctx('trace.path'))
+    print_report(env.hosts, failures)
+    if failures:
+        abort(red('Deploy failed on {} host(s)'.format(len(failures))))
+
+
+@task
+@runs_once_per_stage
+def render(output='dploy-render', context=None, check=False):
+    """
+    Renders the config files locally in output/<stage>/<host>/ and prints
+    the changes, the stage context is read from a local file (context=path)
+    """
+    with settings(stage_context_file=context or os.devnull):
+        reset_context_cache()
+        changes = render_templates(output, env.hosts)
+    reset_context_cache()
+    print_changes(changes, len(env.hosts) or 1)
+    if changes and check in (True, 'True', 'true', '1', 'yes'):
+        abort(red('The rendered config files of {} changed'.format(
+            env.stage)))
 
 
 """ TODO
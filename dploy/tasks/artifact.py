@@ -0,0 +1,330 @@
+import os
+import glob
+
+from datetime import datetime
+
+from fabric.api import task, sudo, run, env, execute, hide, settings, get, put
+from fabric.colors import cyan, green, red
+from fabric.network import normalize
+from fabric.utils import abort
+from dploy import facts
+from dploy.context import ctx, get_release_dir, get_venv_path
+from dploy.runner import run_jobs, collect_results
+from dploy.tasks.git import get_revision
+from dploy.utils import HOST_STATE, host_state, record_change, quote
+from dploy.trace import traced
+
+# Where the hosts receive the artifact before it is unpacked
+INCOMING_DIR = '/var/tmp'
+# Name of the file recording the artifact the files of a host come from, in
+# artifact.dirs.root
+STAMP_NAME = 'current'
+
+
+def get_paths():
+    """
+    Returns the remote paths packed in the artifact: the code, the
+    virtualenv (when it is not inside the code) and the static files
+    """
+    paths = [get_release_dir()]
+    venv_path = get_venv_path()
+    if not venv_path.startswith(paths[0].rstrip('/') + '/'):
+        paths.append(venv_path)
+    paths.append(ctx('django.dirs.static_root'))
+    return paths
+
+
+def get_excludes():
+    """
+    Returns the paths left out of the artifact: the git metadata and the
+    settings, which are uploaded to each host
+    """
+    release_dir = get_release_dir()
+    return [os.path.join(release_dir, '.git'),
+            os.path.join(release_dir, ctx('django.project_name'),
+                         'local_settings.py')]
+
+
+def get_artifact():
+    """
+    Returns the artifact built during this deploy (on any host)
+    """
+    for state in HOST_STATE.values():
+        if state.get('artifact', {}).get('name'):
+            return state['artifact']
+    abort(red('No artifact was built'))
+
+
+def get_stamp_path():
+    return os.path.join(ctx('artifact.dirs.root'), STAMP_NAME)
+
+
+def parse_stamp(out):
+    """
+    Returns the {name, sha256, revision, paths} of a stamp file, an empty
+    dict if it cannot be parsed
+    """
+    lines = [l.strip() for l in out.splitlines() if l.strip()]
+    if not lines or len(lines[0].split()) != 3:
+        return {}
+    name, sha256, revision = lines[0].split()
+    return {'name': name, 'sha256': sha256, 'revision': revision,
+            'paths': lines[1:]}
+
+
+def stamp_command(artifact):
+    """
+    Returns the command writing the stamp of an artifact on a host
+    """
+    lines = ['{} {} {}'.format(artifact['name'], artifact['sha256'],
+                               artifact['revision'])] + artifact['paths']
+    return 'mkdir -p {} && printf "%s\\n" {} > {}'.format(
+        quote(os.path.dirname(get_stamp_path())),
+        ' '.join(quote(l) for l in lines), quote(get_stamp_path()))
+
+
+def read_stamp():
+    """
+    Returns the artifact the files of the host come from (see parse_stamp),
+    it is read once per deploy
+    """
+    stamp = host_state('stamp')
+    if 'read' not in stamp:
+        with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+            out = sudo('cat {}'.format(quote(get_stamp_path())))
+        stamp.update(parse_stamp(out) if out.succeeded else {}, read=True)
+    return stamp
+
+
+def write_stamp(artifact):
+    stamp = host_state('stamp')
+    stamp.clear()
+    stamp.update(read=True, **dict((key, artifact[key]) for key in (
+        'name', 'sha256', 'revision', 'paths')))
+
+
+def is_current(stamp, artifact):
+    """
+    Returns True if the files of a host come from the artifact already
+    """
+    return bool(stamp.get('sha256')) and \
+        stamp['sha256'] == artifact['sha256'] and \
+        stamp['paths'] == artifact['paths']
+
+
+def pack(paths, excludes, revision):
+    """
+    Packs the paths in a new artifact, stamped as the one the files of the
+    host come from, returns its (name, path, sha256)
+    """
+    name = '{}-{}-{}.tar.gz'.format(
+        ctx('django.project_name'), revision[:12],
+        datetime.now().strftime('%Y%m%d%H%M%S'))
+    root = ctx('artifact.dirs.root')
+    path = os.path.join(root, name)
+    print(cyan('Packing artifact {} on {}'.format(name, env.host)))
+    with hide('stdout'):
+        out = sudo(
+            'mkdir -p {root} && tar -C / -czf {path}.tmp {excludes} {paths} '
+            '&& mv {path}.tmp {path} && chmod 0644 {path} && '
+            'sha256sum {path}'.format(
+                root=quote(root), path=quote(path),
+                excludes=' '.join('--exclude={}'.format(quote(p.lstrip('/')))
+                                  for p in excludes),
+                paths=' '.join(quote(p.lstrip('/')) for p in paths)))
+    sha256 = out.strip().split(' ')[0]
+    # Only the last artifact.keep artifacts are kept on the build host
+    sudo('cd {} && ls -1t -- *.tar.gz | tail -n +{} | xargs -r rm -f && '
+         '{}'.format(quote(root), int(ctx('artifact.keep', default=3)) + 1,
+                     stamp_command({'name': name, 'sha256': sha256,
+                                    'revision': revision, 'paths': paths})))
+    return name, path, sha256
+
+
+def fan_out(path, targets):
+    """
+    Copies the artifact host to host: each round, every host that has it
+    sends it to one that does not, so the hosts get it in log2(n) rounds
+    """
+    holders = [(env.host_string, path)]
+    incoming = os.path.join(INCOMING_DIR, os.path.basename(path))
+    while targets:
+        jobs = [('artifact.send', holder, {'source': source,
+                                           'target': target,
+                                           'dest': incoming})
+                for (holder, source), target in zip(holders, targets)]
+        targets = targets[len(jobs):]
+        failures = {}
+        if not collect_results(jobs, run_jobs(jobs, parallel=True),
+                               failures):
+            abort(red('Could not fan out the artifact'))
+        holders.extend((job[2]['target'], incoming) for job in jobs)
+
+
+def relay(path):
+    """
+    Downloads the artifact in artifact.local_dir (unless it is there
+    already), it is uploaded to the hosts from there
+    """
+    local_dir = ctx('artifact.local_dir')
+    local_path = os.path.join(local_dir, os.path.basename(path))
+    if os.path.exists(local_path):
+        return local_path
+    if not os.path.isdir(local_dir):
+        os.makedirs(local_dir)
+    for old in glob.glob(os.path.join(local_dir, '*.tar.gz')):
+        os.remove(old)
+    get(path, local_path)
+    return local_path
+
+
+def get_outdated(artifact, targets):
+    """
+    Returns the targets whose files do not come from the artifact
+    """
+    jobs = [('artifact.status', target, {}) for target in targets]
+    failures = {}
+    if not collect_results(jobs, run_jobs(jobs, parallel=True), failures):
+        abort(red('Could not read the artifact of the hosts'))
+    return [target for target in targets
+            if not is_current(host_state('stamp', target), artifact)]
+
+
+@task
+@traced
+def build(upgrade=False, targets=None):
+    """
+    Builds the code, virtualenv and static files once and packs them in a
+    versioned artifact for the other hosts. The last artifact is reused
+    when the revision did not change (and upgrade is not set)
+    """
+    execute('git.checkout')
+    execute('virtualenv.setup', upgrade=upgrade)
+    execute('django.setup_settings')
+    execute('django.collectstatic')
+    paths = get_paths()
+    revision = get_revision(get_release_dir()) or 'unknown'
+    stamp = read_stamp()
+    artifact = host_state('artifact')
+    reused = revision != 'unknown' and \
+        upgrade not in (True, 'True', 'true', '1', 'yes') and \
+        stamp.get('revision') == revision and stamp['paths'] == paths and \
+        facts.exists(os.path.join(ctx('artifact.dirs.root'), stamp['name']))
+    artifact.update({'paths': paths, 'revision': revision,
+                     'reused': reused, 'host': env.host_string,
+                     'local': None})
+    if reused:
+        name, sha256 = stamp['name'], stamp['sha256']
+        path = os.path.join(ctx('artifact.dirs.root'), name)
+        print(cyan('Artifact {} is up to date on {}'.format(name, env.host)))
+    else:
+        name, path, sha256 = pack(paths, get_excludes(), revision)
+    artifact.update({'name': name, 'path': path, 'sha256': sha256})
+    if not reused:
+        write_stamp(artifact)
+
+    targets = [t for t in targets or [] if t != env.host_string]
+    if targets and reused:
+        targets = get_outdated(artifact, targets)
+    if not targets:
+        return
+    if ctx('artifact.transfer') == 'fanout':
+        print(cyan('Fanning out {} to {} host(s)'.format(
+            name, len(targets))))
+        fan_out(path, targets)
+    else:
+        artifact['local'] = relay(path)
+
+
+def swap_command(path, staging, version):
+    """
+    Returns the command switching a path to its unpacked copy. The copy is
+    kept next to it (<path>.<version>) and the path is a symlink replaced
+    atomically (rename), like rollbacks releases. A path that is not a
+    symlink yet is moved aside first, a path that does not exist yet (new
+    release) is just moved in place.
+    """
+    return (
+        'mkdir -p {parent} && if [ ! -e {path} ]; then mv {new} {path}; '
+        'else old=$(readlink {path}); rm -rf {copy} && mv {new} {copy} && '
+        '{{ [ -L {path} ] || {{ rm -rf {path}.old && mv {path} {path}.old; '
+        '}}; }} && ln -sfn {copy} {path}.tmp && mv -Tf {path}.tmp {path} && '
+        'rm -rf {path}.old && case "$old" in {path}.[0-9]*) rm -rf "$old";; '
+        'esac; fi'.format(
+            parent=quote(os.path.dirname(path)), path=quote(path),
+            new=quote(staging + path), copy=quote('{}.{}'.format(
+                path, version))))
+
+
+@task
+@traced
+def send(source, target, dest):
+    """
+    Copies an artifact to another host (the hosts must be able to connect
+    to each other, with the forwarded agent)
+    """
+    user, host, port = normalize(target)
+    print(cyan('Sending {} to {}'.format(os.path.basename(source), host)))
+    with settings(forward_agent=True):
+        run('scp -q -o BatchMode=yes -o StrictHostKeyChecking=accept-new '
+            '-P {port} {source} {user}@{host}:{dest}'.format(
+                port=port, source=quote(source), user=user, host=host,
+                dest=quote(dest)))
+
+
+@task
+@traced
+def status():
+    """
+    Prints the artifact the files of the host come from
+    """
+    stamp = read_stamp()
+    if stamp.get('name'):
+        print(cyan('{} (revision {}) on {}'.format(
+            stamp['name'], stamp['revision'], env.host)))
+    else:
+        print(cyan('No artifact on {}'.format(env.host)))
+
+
+@task
+@traced
+def ship():
+    """
+    Unpacks the artifact built on the build host, after checking it. Hosts
+    that have it already are left untouched.
+    """
+    artifact = get_artifact()
+    if artifact['host'] == env.host_string:
+        return
+    # Only a reused artifact can be on the host already
+    if artifact['reused'] and is_current(read_stamp(), artifact):
+        print(green('{} is up to date on {}'.format(
+            artifact['name'], env.host)))
+        return
+    incoming = os.path.join(INCOMING_DIR, artifact['name'])
+    if artifact['local']:
+        put(artifact['local'], incoming)
+
+    with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+        out = sudo('echo {} | sha256sum -c --quiet'.format(
+            quote('{}  {}'.format(artifact['sha256'], incoming))))
+    if out.failed:
+        abort(red('Checksum mismatch for {} on {}'.format(
+            artifact['name'], env.host)))
+
+    print(cyan('Unpacking {} on {}'.format(artifact['name'], env.host)))
+    staging = '{}.d'.format(incoming)
+    version = datetime.now().strftime('%Y%m%d%H%M%S')
+    commands = ['rm -rf {staging} && mkdir -p {staging} && '
+                'tar -C {staging} -xzf {incoming}'.format(
+                    staging=quote(staging), incoming=quote(incoming))]
+    for path in artifact['paths']:
+        commands.append(swap_command(path.rstrip('/'), staging, version))
+    commands.append(stamp_command(artifact))
+    commands.append('rm -rf {} {}'.format(quote(staging), quote(incoming)))
+    sudo(' && '.join(commands))
+    write_stamp(artifact)
+    for path in artifact['paths']:
+        facts.forget(path)
+        record_change(path)
+    print(green('Shipped {} to {}'.format(artifact['name'], env.host)))
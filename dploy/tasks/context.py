@@ -7,9 +7,11 @@ from fabric.api import task, env
 from fabric.utils import abort
 from fabric.colors import cyan, green, red
 from dploy.context import ctx
+from dploy.trace import traced
 
 
 @task
+@traced
 def setup():
     """
     Create context on remote stage (not functional yet)
@@ -32,6 +34,7 @@ def setup():
 
 
 @task
+@traced
 def pprint():
     """
     Prints deployment context
@@ -5,23 +5,34 @@ from fabric.colors import cyan, yellow
 from dploy.context import ctx
 from dploy.utils import upload_template
 from jinja2.exceptions import TemplateNotFound
+from dploy.trace import traced
 
 
-@task
-def setup():
+def get_templates():
     """
-    Configure Cron if a dploy/cron.template exists
+    Returns the (template, path, upload options) of the cron config
     """
     # Cron doesn't like dots in filename
     filename = ctx('nginx.server_name').replace('.', '_')
     dest = os.path.join(ctx('cron.config_path'), filename)
+    return [('cron.template', dest, {})]
+
+
+@task
+@traced
+def setup():
+    """
+    Configure Cron if a dploy/cron.template exists
+    """
+    [(template, dest, options)] = get_templates()
     try:
-        upload_template('cron.template', dest)
-        print(cyan('Configuring cron {}'.format(env.stage)))
-        # We make sure the cron file always ends with a blank line, otherwise
-        # it will be ignored by cron. Yeah, that's retarded.
-        sudo("echo -en '\n' >> {}".format(dest))
-        sudo('chown -R root:root {}'.format(dest))
-        sudo('chmod 644 {}'.format(dest))
+        # upload_template makes sure the file ends with a blank line,
+        # otherwise it would be ignored by cron.
+        changed = upload_template(template, dest, **options)
     except TemplateNotFound:
+        changed = None
+    if changed is None:
         print(yellow('Skipping cron configuration on {}'.format(env.stage)))
+    elif changed:
+        print(cyan('Configuring cron {}'.format(env.stage)))
+        sudo('chown root:root {0} && chmod 644 {0}'.format(dest))
@@ -0,0 +1,187 @@
+import os
+
+from datetime import datetime
+
+from fabric.api import task, sudo, env, hide, settings
+from fabric.colors import cyan, green, red, yellow
+from fabric.utils import abort
+from dploy.context import ctx
+from dploy.utils import quote
+from dploy.trace import traced, span
+
+# Backup file suffix of each supported engine: pg_dump directory format
+# (compressed, dumped and restored with database.backup.jobs jobs) and
+# gzipped mysqldump output (mysqldump cannot dump in parallel)
+SUFFIXES = {
+    'postgresql': '.pgdump',
+    'mysql': '.sql.gz',
+}
+
+
+def get_database(alias='default'):
+    """
+    Returns the settings (engine, name, user, password, host, port) of a
+    database of the databases context
+    """
+    return ctx('databases.{}'.format(alias), default=False) or {}
+
+
+def get_engine(database):
+    """
+    Returns the supported engine (postgresql or mysql) of a database, None
+    for the others
+    """
+    engine = database.get('engine') or ''
+    if 'postgresql' in engine or 'postgis' in engine:
+        return 'postgresql'
+    if 'mysql' in engine:
+        return 'mysql'
+    return None
+
+
+def get_client(engine, database, command):
+    """
+    Returns a client command line with the connection options (the password
+    is passed in the environment)
+    """
+    if engine == 'postgresql':
+        variable, flags = 'PGPASSWORD', ('-h', '-p', '-U')
+    else:
+        variable, flags = 'MYSQL_PWD', ('-h', '-P', '-u')
+    options = [
+        '{} {}'.format(flag, quote(str(database[key])))
+        for flag, key in zip(flags, ('host', 'port', 'user'))
+        if database.get(key)]
+    if database.get('password'):
+        command = '{}={} {}'.format(
+            variable, quote(str(database['password'])), command)
+    return '{} {}'.format(command, ' '.join(options))
+
+
+def get_backup_dir():
+    return ctx('database.dirs.backups')
+
+
+def get_backups(alias='default'):
+    """
+    Returns the backup names of a database, oldest first
+    """
+    with settings(hide('running', 'stdout'), warn_only=True):
+        out = sudo('ls -1 {}'.format(quote(get_backup_dir())))
+    prefix = '{}-'.format(alias)
+    return sorted(name.strip() for name in out.splitlines()
+                  if name.strip().startswith(prefix) and
+                  name.strip().endswith(tuple(SUFFIXES.values())))
+
+
+def dump(alias='default'):
+    """
+    Dumps a database in the backups directory, returns the backup name or
+    None if its engine is not supported
+    """
+    database = get_database(alias)
+    engine = get_engine(database)
+    if engine is None:
+        print(yellow('Backups of the {} database ({}) are not supported, '
+                     'skipping.'.format(alias, database.get('engine'))))
+        return None
+    name = '{}-{}{}'.format(
+        alias, datetime.now().strftime('%Y%m%d%H%M%S'), SUFFIXES[engine])
+    path = os.path.join(get_backup_dir(), name)
+    if engine == 'postgresql':
+        command = '{} -Fd -j {} -f {}.tmp {}'.format(
+            get_client(engine, database, 'pg_dump'),
+            int(ctx('database.backup.jobs')), quote(path),
+            quote(database['name']))
+    else:
+        command = '{} --single-transaction --quick --routines {} | ' \
+            'gzip -c > {}.tmp'.format(
+                get_client(engine, database, 'mysqldump'),
+                quote(database['name']), quote(path))
+    print(cyan('Backing up the {} database on {} ({})'.format(
+        alias, env.stage, name)))
+    # The dump is only readable by root and moved in place once complete,
+    # the commands are not echoed as they hold the password
+    with span('database.dump', kind='command'), \
+            settings(hide('running'), warn_only=True):
+        result = sudo('set -o pipefail; umask 077; mkdir -p {dir} && '
+             '{command} && mv {path}.tmp {path} || '
+             '{{ rm -rf {path}.tmp; false; }}'.format(
+                 dir=quote(get_backup_dir()), command=command,
+                 path=quote(path)))
+    if result.failed:
+        abort(red('Backup of the {} database failed'.format(alias)))
+    prune(alias)
+    return name
+
+
+def prune(alias='default', keep=None):
+    """
+    Removes the old backups of a database, keeps the last
+    database.backup.keep ones
+    """
+    keep = int(keep or ctx('database.backup.keep', default=5))
+    obsolete = get_backups(alias)[:-keep]
+    if obsolete:
+        sudo('rm -rf {}'.format(' '.join(
+            quote(os.path.join(get_backup_dir(), name))
+            for name in obsolete)))
+
+
+@task
+@traced
+def backup(alias='default'):
+    """
+    Backs up a database (pg_dump/mysqldump) in database.dirs.backups
+    """
+    if dump(alias) is None:
+        abort(red('Cannot backup the {} database'.format(alias)))
+
+
+@task
+@traced
+def backups(alias='default'):
+    """
+    Lists the backups of a database
+    """
+    for name in get_backups(alias):
+        print(name)
+
+
+@task
+@traced
+def restore(name=None, alias='default'):
+    """
+    Restores a backup of a database (defaults to the latest one)
+    """
+    database = get_database(alias)
+    engine = get_engine(database)
+    if engine is None:
+        abort(red('Restores of the {} database ({}) are not '
+                  'supported'.format(alias, database.get('engine'))))
+    names = [n for n in get_backups(alias) if n.endswith(SUFFIXES[engine])]
+    if name is None:
+        if not names:
+            abort(red('No backup of the {} database on {}'.format(
+                alias, env.host)))
+        name = names[-1]
+    elif name not in names:
+        abort(red('Unknown backup: {}'.format(name)))
+    path = os.path.join(get_backup_dir(), name)
+    if engine == 'postgresql':
+        command = '{} --clean --if-exists -j {} -d {} {}'.format(
+            get_client(engine, database, 'pg_restore'),
+            int(ctx('database.backup.jobs')), quote(database['name']),
+            quote(path))
+    else:
+        command = 'set -o pipefail; gunzip -c {} | {} {}'.format(
+            quote(path), get_client(engine, database, 'mysql'),
+            quote(database['name']))
+    print(cyan('Restoring the {} database from {} on {}'.format(
+        alias, name, env.stage)))
+    with span('database.restore', kind='command'), \
+            settings(hide('running'), warn_only=True):
+        result = sudo(command)
+    if result.failed:
+        abort(red('Restore of the {} database failed'.format(alias)))
+    print(green('Restored {}'.format(name)))
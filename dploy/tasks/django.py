@@ -1,49 +1,71 @@
 import os
 import sys
 
-from fabric.colors import cyan, red, yellow
-from fabric.api import task, env, sudo, get, hide, execute
+from fabric.colors import cyan, green, red, yellow
+from fabric.api import task, env, hide, execute
+from fabric.utils import abort
 
-from dploy.context import ctx, get_project_dir
-from dploy.commands import manage as django_manage
+from dploy.context import ctx, get_release_dir, get_venv_path
+from dploy.commands import (
+    manage as django_manage, python as django_python, manage_batch,
+    manage_command, batch, chown_command,
+)
 from dploy.utils import (
-    FabricException, version_supports_migrations, select_template,
-    upload_template,
+    version_supports_migrations, parse_version, select_template,
+    upload_template, quote, host_state, has_changed, record_change,
 )
+from dploy.trace import traced
+from dploy.stream import stream_out, stream_in
+from dploy.tasks.database import dump as dump_database
 
 
 @task
-def manage(cmd):
+@traced
+def manage(*cmds):
     """
-    Runs django manage.py with a given command
+    Runs django manage.py with the given command(s), in a single remote
+    invocation (ex: django.manage:check,migrate)
     """
-    print(cyan("Django manage {} on {}".format(cmd, env.stage)))
-    django_manage(cmd)
+    print(cyan("Django manage {} on {}".format(', '.join(cmds), env.stage)))
+    if len(cmds) == 1:
+        django_manage(cmds[0])
+    else:
+        manage_batch(*cmds)
+
+
+def get_version():
+    """
+    Returns the django version installed in the virtualenv, it is only
+    asked again when the virtualenv changed
+    """
+    venv_path = get_venv_path()
+    versions = host_state('django_versions')
+    if venv_path not in versions or has_changed(venv_path):
+        with hide('running', 'stdout'):
+            versions[venv_path] = django_manage('--version').strip()
+    return versions[venv_path]
 
 
 @task
+@traced
 def setup_log_files_owner():
     """
     Runs django manage.py check command and sets logs folder owner after
     """
-    django_manage('check')
-    sudo('chown -R {user}:{group} {logpath}'.format(
-        user=ctx('system.user'),
-        group=ctx('system.group'),
-        logpath=ctx('logs.dirs.root')))
+    batch([
+        manage_command('check'),
+        chown_command([ctx('logs.dirs.root')]),
+    ])
 
 
-@task
-def setup_settings():
+def get_settings_templates():
     """
-    Takes the dploy/<STAGE>_settings.py template and upload it to remote
-    django project location (as local_settings.py)
+    Returns the local templates the settings can be rendered from, the
+    first one that exists is used
     """
-    print(cyan("Setuping django settings project on {}".format(env.stage)))
-    project_dir = get_project_dir()
     project_name = ctx('django.project_name')
     stage_settings = '{stage}_settings.py'.format(stage=env.stage)
-    templates = [
+    return [
         os.path.join('./dploy/', stage_settings),
         os.path.join('./', project_name, 'local_settings.py-dist'),
         os.path.join('./', project_name, 'local_settings.py-default'),
@@ -53,65 +75,254 @@ def setup_settings():
         os.path.join('./', project_name, 'local_settings.py.example'),
     ]
 
-    template = select_template(templates)
+
+def get_templates():
+    """
+    Returns the (template, path, upload options) of the settings, nothing
+    if the project does not have a settings template
+    """
+    template = select_template(get_settings_templates())
     if not template:
+        return []
+    dest = os.path.join(get_release_dir(), ctx('django.project_name'),
+                        'local_settings.py')
+    return [(os.path.basename(template), dest,
+             {'template_dir': os.path.dirname(template)})]
+
+
+@task
+@traced
+def setup_settings():
+    """
+    Takes the dploy/<STAGE>_settings.py template and upload it to remote
+    django project location (as local_settings.py)
+    """
+    print(cyan("Setuping django settings project on {}".format(env.stage)))
+    templates = get_templates()
+    if not templates:
         print(red('ERROR: the project does not have a settings template'))
         print("The project must provide at least one of these file:")
-        print("\n - {}\n".format("\n - ".join(templates)))
+        print("\n - {}\n".format("\n - ".join(get_settings_templates())))
         sys.exit(1)
 
-    filename = os.path.basename(template)
-    templates_dir = os.path.dirname(template)
-    _settings_dest = os.path.join(project_dir, project_name,
-                                  'local_settings.py')
-    upload_template(filename, _settings_dest, template_dir=templates_dir)
+    for name, path, options in templates:
+        upload_template(name, path, **options)
+
+
+def get_pending_migrations():
+    """
+    Returns the migrations that are not applied yet, in the order they will
+    be applied (showmigrations --plan)
+    """
+    with hide('running', 'stdout'):
+        out = django_manage('showmigrations --plan')
+    return [line.strip()[3:].strip() for line in out.splitlines()
+            if line.strip().startswith('[ ]')]
 
 
 @task
+@traced
 def migrate():
     """
-    Perform django migration (only if the django version is >= 1.7)
+    Applies the pending migrations after backing up the database (only if
+    the django version is >= 1.7)
     """
-    with hide('running', 'stdout'):
-        version = django_manage('--version')
-    if version_supports_migrations(version):
-        print(cyan("Django migrate on {}".format(env.stage)))
-        try:
-            django_manage('migrate --noinput')
-        except FabricException as e:
-            print(yellow(
-                'WARNING: faked migrations because of exception {}'.format(e)))
-            django_manage('migrate --noinput --fake')
-    else:
+    version = get_version()
+    if not version_supports_migrations(version):
         print(yellow(
             "Django {} does not support migration, skipping.".format(version)))
+        return
+    # showmigrations was added in django 1.8
+    if parse_version(version) >= (1, 8):
+        pending = get_pending_migrations()
+        if not pending:
+            print(green("No pending migrations on {}".format(env.stage)))
+            return
+        print(cyan("Django migrate on {} ({} pending migrations)".format(
+            env.stage, len(pending))))
+        for name in pending:
+            print(yellow('  {}'.format(name)))
+        if ctx('database.backup.enabled', default=False):
+            dump_database()
+    else:
+        print(cyan("Django migrate on {}".format(env.stage)))
+    django_manage('migrate --noinput')
 
 
 @task
+@traced
 def collectstatic():
     """
-    Collect static medias
+    Collect static medias, only the ones that changed since the last deploy
+    when django.static_manifest is enabled
+    """
+    command = ctx('django.commands.collectstatic')
+    if not ctx('django.static_manifest.enabled', default=False):
+        print(cyan("Django collectstatic on {}".format(env.stage)))
+        django_manage(command)
+        record_change(ctx('django.dirs.static_root'))
+        return
+
+    # The static files are compared to the manifest of the last collect,
+    # collectstatic only runs in full when too many of them changed
+    manifest = ctx('django.static_manifest.path')
+    script = os.path.join(ctx('django.dirs.cache'), 'collectstatic.py')
+    upload_template('collectstatic.py.template', script)
+    link = '--link' in command.split() or '-l' in command.split()
+    with hide('running', 'stdout'):
+        out = django_python('{} {} {} {} {}'.format(
+            script, ctx('django.settings_module'), quote(manifest),
+            int(link), int(ctx('django.static_manifest.limit'))))
+    mode, count = out.splitlines()[-1].split()[1:]
+    if mode == 'unchanged':
+        print(cyan("Static files are up to date on {}".format(env.stage)))
+        return
+    record_change(ctx('django.dirs.static_root'))
+    if mode == 'partial':
+        print(cyan("Collected {} changed static file(s) on {}".format(
+            count, env.stage)))
+    else:
+        print(cyan("Django collectstatic on {} ({} changed files)".format(
+            env.stage, count)))
+        batch([manage_command(command),
+               'mv -f {0}.pending {0}'.format(quote(manifest))])
+
+
+DUMP_FORMATS = ('json', 'jsonl')
+# Django versions needed by the jsonl serializer and by loaddata from stdin
+JSONL_VERSION = (3, 2)
+STDIN_VERSION = (2, 0)
+DUMP_INDEX = 'index.txt'
+
+MODELS_SCRIPT = (
+    'import sys; from django.apps import apps; '
+    '[sys.stdout.write(m._meta.label + "\\n") for l in {} '
+    'for m in ([apps.get_model(l)] if "." in l else '
+    'apps.get_app_config(l).get_models())]')
+
+
+def require_version(required, feature):
+    """
+    Aborts if the django version of the virtualenv is older than `required`
+    """
+    version = get_version()
+    if parse_version(version) < required:
+        abort(red('{} needs Django >= {} ({} on {})'.format(
+            feature, '.'.join(map(str, required)), version, env.host)))
+
+
+def get_dump_labels(app, chunk):
+    """
+    Returns the labels dumped in a file each: the given app/model labels
+    (chunk=app) or the models of the given apps (chunk=model)
+    """
+    labels = app.split()
+    if chunk != 'model':
+        return labels
+    with hide('running', 'stdout'):
+        out = django_manage('shell -c {}'.format(
+            quote(MODELS_SCRIPT.format(repr(labels)))))
+    return [l.strip() for l in out.splitlines() if l.strip()]
+
+
+def dump(labels, path, format='json', natural=False):
     """
-    print(cyan("Django collectstatic on {}".format(env.stage)))
-    django_manage(ctx('django.commands.collectstatic'))
+    Streams the dumpdata of labels to a local file, gzipped over the SSH
+    channel and stored compressed if path ends with .gz
+    """
+    options = ['--format={}'.format(format)]
+    if natural:
+        options.append('--natural-foreign --natural-primary')
+    command = '{} | gzip -c'.format(manage_command('dumpdata {} {}'.format(
+        ' '.join(options), ' '.join(map(quote, labels)))))
+    with open(path, 'wb') as fd:
+        return stream_out(command, fd, os.path.basename(path),
+                          decompress=not path.endswith('.gz'))
 
 
 @task
-def dumpdata(app, dest=None):
+@traced
+def dumpdata(app, dest=None, format='json', natural=False, chunk=False):
     """
-    Runs dumpdata on a given app and fetch the file locally
+    Streams dumpdata of the given app/model label(s) to a local (.gz) file
+    or in a file per label in the dest directory (chunk=app|model)
     """
+    if format not in DUMP_FORMATS:
+        abort(red('Unknown dump format: {}'.format(format)))
+    if format == 'jsonl':
+        require_version(JSONL_VERSION, 'format=jsonl')
+    natural = natural in (True, 'True', 'true', '1', 'yes')
     if dest is None:
         django_manage('dumpdata --indent=2 {}'.format(app))
-    else:
-        tmp_file = '/tmp/{}.tmp'.format(app)
-        django_manage('dumpdata --indent=2 {} > {}'.format(app, tmp_file))
-        with open(dest, 'w+') as fd:
-            get(tmp_file, fd, use_sudo=True)
-        sudo('rm -f {}'.format(tmp_file))
+        return
+    if chunk in (False, 'False', 'false', '0', 'no'):
+        print(cyan('Django dumpdata {} to {}'.format(app, dest)))
+        dump(app.split(), dest, format, natural)
+        return
+
+    labels = get_dump_labels(app, chunk)
+    print(cyan('Django dumpdata {} label(s) to {}/'.format(
+        len(labels), dest)))
+    if not os.path.isdir(dest):
+        os.makedirs(dest)
+    files = []
+    for label in labels:
+        files.append('{}.{}.gz'.format(label, format))
+        dump([label], os.path.join(dest, files[-1]), format, natural)
+    with open(os.path.join(dest, DUMP_INDEX), 'w') as fd:
+        fd.write('\n'.join(files) + '\n')
+
+
+def get_dump_format(path):
+    """
+    Returns the format of a dump file from its extension (ex: .jsonl.gz)
+    """
+    name = path[:-3] if path.endswith('.gz') else path
+    format = os.path.splitext(name)[1][1:]
+    if format not in DUMP_FORMATS:
+        abort(red('Unknown dump format: {}'.format(path)))
+    return format
+
+
+def get_load_files(src):
+    """
+    Returns the files to load, in the order they were dumped for a chunked
+    dump directory
+    """
+    if not os.path.isdir(src):
+        return [src]
+    index = os.path.join(src, DUMP_INDEX)
+    if not os.path.exists(index):
+        abort(red('{} is not a dumpdata directory (no {})'.format(
+            src, DUMP_INDEX)))
+    with open(index, 'r') as fd:
+        return [os.path.join(src, l.strip()) for l in fd if l.strip()]
+
+
+@task
+@traced
+def loaddata(src):
+    """
+    Streams a local (.gz) dumpdata file or directory to loaddata
+    """
+    paths = get_load_files(src)
+    formats = [get_dump_format(path) for path in paths]
+    # Checked before anything is loaded
+    require_version(STDIN_VERSION, 'loaddata from stdin')
+    if 'jsonl' in formats:
+        require_version(JSONL_VERSION, 'format=jsonl')
+
+    for path, format in zip(paths, formats):
+        print(cyan('Django loaddata {} on {}'.format(path, env.stage)))
+        command = 'gunzip -c | {}'.format(manage_command(
+            'loaddata --format={} -'.format(format)))
+        with open(path, 'rb') as fd:
+            stream_in(command, fd, os.path.basename(path),
+                      compress=not path.endswith('.gz'))
 
 
 @task
+@traced
 def setup():
     """
     Performs django_setup_settings, django_migrate, django_collectstatic
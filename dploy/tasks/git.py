@@ -1,46 +1,153 @@
 import os
-import fabtools
 
-from fabtools import require
-from fabric.api import task, sudo, cd
+from fabric.api import task, sudo, cd, hide, settings, env
 from fabric.colors import cyan
-from dploy.context import ctx
-from dploy.utils import git_dirname
+from dploy import facts
+from dploy.context import (
+    ctx, get_project_dir, get_release_dir, releases_enabled,
+)
+from dploy.utils import git_dirname, record_change, quote
+from dploy.trace import traced
+
+
+def get_revision(path):
+    """
+    Returns the commit checked out in a working copy, None if there is none
+    """
+    with settings(hide('running', 'stdout', 'warnings'), cd(path),
+                  warn_only=True):
+        out = sudo('git rev-parse HEAD')
+    return out.strip() if out.succeeded else None
+
+
+def get_remote_revision(repository, branch):
+    """
+    Returns the commit a branch (or tag) points to on the remote repository
+    """
+    with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+        out = sudo('git ls-remote {} {}'.format(
+            quote(repository), quote(branch)))
+    revisions = {}
+    for line in out.splitlines():
+        tokens = line.split()
+        if len(tokens) == 2:
+            revisions[tokens[1]] = tokens[0]
+    # Annotated tags are listed twice, the dereferenced one is the commit
+    for ref in ('refs/heads/{}', 'refs/tags/{}^{{}}', 'refs/tags/{}'):
+        if ref.format(branch) in revisions:
+            return revisions[ref.format(branch)]
+    return None
+
+
+def get_clone_options():
+    """
+    Returns the shallow/partial clone and fetch options (git.depth and
+    git.filter)
+    """
+    options = []
+    if int(ctx('git.depth', default=0)):
+        options.append('--depth {}'.format(int(ctx('git.depth'))))
+    if ctx('git.filter', default=False):
+        options.append('--filter={}'.format(quote(ctx('git.filter'))))
+    return ' '.join(options)
+
+
+def get_submodule_options():
+    options = ['--init', '--recursive']
+    if int(ctx('git.submodule_jobs', default=0)):
+        options.append('--jobs {}'.format(int(ctx('git.submodule_jobs'))))
+    if int(ctx('git.depth', default=0)):
+        options.append('--depth {}'.format(int(ctx('git.depth'))))
+    return ' '.join(options)
+
+
+def update_reference(repository):
+    """
+    Updates (or creates) the per-host bare mirror of the repository that
+    working copies borrow their objects from (git.reference). Returns its
+    path, or None if the reference store is disabled.
+
+    Objects are never pruned from the mirror (gc.auto=0, no --prune) since
+    the working copies cloned with --reference depend on them.
+    """
+    if not ctx('git.reference', default=False):
+        return None
+    mirror = os.path.join(ctx('git.dirs.cache'),
+                          '{}.git'.format(git_dirname(repository)))
+    print(cyan('Updating reference repository {}'.format(mirror)))
+    sudo('if [ -d {mirror} ]; then '
+         'git --git-dir={mirror} fetch -q origin "+refs/*:refs/*"; '
+         'else git clone -q --mirror {repository} {mirror} && '
+         'git --git-dir={mirror} config gc.auto 0; fi'.format(
+             mirror=quote(mirror), repository=quote(repository)))
+    return mirror
+
+
+def clone(repository, branch, path, reference=None, dissociate=False):
+    options = [get_clone_options()]
+    if reference:
+        options.append('--reference-if-able {}'.format(quote(reference)))
+        if dissociate:
+            options.append('--dissociate')
+    sudo('git clone -q -b {branch} {options} {repository} {path}'.format(
+        branch=quote(branch), options=' '.join(o for o in options if o),
+        repository=quote(repository), path=quote(path)))
+    with cd(path):
+        sudo('git submodule update {}'.format(get_submodule_options()))
 
 
 @task
+@traced
 def checkout():
     """
     Checkouts the code on the remote location using git
     """
     branch = ctx('git.branch')
+    repository = ctx('git.repository')
     git_root = ctx('git.dirs.root')
-    git_dir = git_dirname(ctx('git.repository'))
+    git_dir = git_dirname(repository)
     git_path = os.path.join(git_root, git_dir)
-    if not fabtools.deb.is_installed('git'):
-        fabtools.deb.install('git')
-
-    print(cyan('Checking out {} @ {} -> {}'.format(
-        branch, ctx('git.repository'), git_path)))
-    # Experimental
-    require.git.working_copy(ctx('git.repository'),
-                             path=git_path, branch=branch, update=True,
-                             use_sudo=True)
+    facts.require_packages('git')
+
+    if releases_enabled() and env.get('release'):
+        # Fresh clone in the new release directory, borrowing the objects of
+        # the reference repository, or of the active release
+        release_dir = get_release_dir()
+        print(cyan('Cloning {} @ {} -> {}'.format(
+            branch, repository, release_dir)))
+        reference = update_reference(repository)
+        clone(repository, branch, release_dir,
+              reference=reference or get_project_dir(),
+              dissociate=reference is None)
+        facts.forget(release_dir)
+        record_change(release_dir)
+        return
+
+    if not facts.exists(git_path):
+        print(cyan('Cloning {} @ {} -> {}'.format(
+            branch, repository, git_path)))
+        clone(repository, branch, git_path,
+              reference=update_reference(repository))
+        facts.forget(git_path)
+        record_change(git_path)
+        return
+
+    # Nothing is fetched when the remote branch did not move, submodules
+    # are pinned by the superproject so they did not move either
+    previous = get_revision(git_path)
+    if previous and previous == get_remote_revision(repository, branch):
+        print(cyan('{} is up to date on {}'.format(branch, env.stage)))
+        return
+
+    print(cyan('Updating {} @ {} -> {}'.format(branch, repository, git_path)))
+    # With a reference repository, only the mirror fetches from the network
+    source = update_reference(repository) or 'origin'
     with cd(git_path):
-        sudo('git submodule update --init --recursive')
-        sudo("find . -iname '*.pyc' | xargs rm -f")
-    # /Experimental
-
-    # if files.exists(os.path.join(git_path, '.git'), use_sudo=True):
-    #     print(cyan('Updating {} on {}'.format(branch, env.stage)))
-    #     with cd(git_path):
-    #         sudo('git reset --hard')
-    #         sudo('git pull')
-    #         sudo('git submodule update --init --recursive')
-    #         sudo('git checkout {}'.format(branch))
-    #         sudo("find . -iname '*.pyc' | xargs rm -f")
-    # else:
-    #     print(cyan('Cloning {} on {}'.format(branch, env.stage)))
-    #     with cd(git_root):
-    #         sudo('git clone --recursive -b {} {} {}'.format(
-    #             ctx('git.branch'), ctx('git.repository'), git_dir))
+        sudo('git fetch -q {options} {source} {branch} && '
+             'git checkout -q -f -B {branch} FETCH_HEAD'.format(
+                 options=get_clone_options(), source=quote(source),
+                 branch=quote(branch)))
+        sudo('git submodule update {}'.format(get_submodule_options()))
+        sudo("find . -name '*.pyc' -delete")
+    facts.forget(git_path)
+    record_change(git_path)
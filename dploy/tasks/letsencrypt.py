@@ -1,62 +1,182 @@
-import fabtools
+import time
+import calendar
 
-from fabric.contrib import files
-from fabric.api import task, sudo, execute
+from datetime import datetime
+
+from fabric.api import task, sudo, env, execute, hide, settings
+from fabric.colors import cyan, green
+from dploy import cache, facts
 from dploy.context import ctx
-from dploy.utils import upload_template
+from dploy.utils import upload_template, record_change, quote
+from dploy.trace import traced
+
+# Document root of the acme challenges (see nginx_letsencrypt*.template)
+WEBROOT = '/var/www/html'
 
 
 @task
+@traced
 def install():
     """
-    Install letsencrypt's certbot
+    Install letsencrypt's certbot (from the distribution packages)
+    """
+    facts.require_packages('certbot')
+
+
+def get_domains():
+    """
+    Returns the hostnames of the certificate, the server name first
+    """
+    domains = [ctx('nginx.server_name')]
+    for domain in ctx('ssl.domains') or []:
+        if domain not in domains:
+            domains.append(domain)
+    return domains
+
+
+def get_templates():
+    """
+    Returns the (template, path, upload options) of the nginx config, once
+    the certificate is issued
+    """
+    server_name = ctx("nginx.server_name")
+    return [
+        ('options-ssl-nginx.conf.template', facts.LETSENCRYPT_OPTIONS, {}),
+        ('nginx_letsencrypt.template', ctx('nginx.config_path'), {
+            'backup': True,
+            'context': {
+                'server_names': get_domains(),
+                'ssl': {
+                    'letsencrypt': True,
+                    'dhparams': facts.LETSENCRYPT_DHPARAMS,
+                    'key': '{}/{}/privkey.pem'.format(
+                        facts.LETSENCRYPT_LIVE, server_name),
+                    'cert': '{}/{}/fullchain.pem'.format(
+                        facts.LETSENCRYPT_LIVE, server_name),
+                }
+            },
+        }),
+    ]
+
+
+def get_cache_name():
+    return '{}-{}-certificates'.format(ctx('django.project_name'), env.stage)
+
+
+def read_certificate(path):
+    """
+    Returns the {domains, expires (timestamp)} of a certificate on the
+    host, None if it cannot be read
     """
-    # TODO: detect unsupported platforms
-    if not fabtools.deb.is_installed('software-properties-common'):
-        fabtools.deb.install('software-properties-common')
-    fabtools.deb.add_apt_key(keyid='75BCA694', keyserver='keyserver.ubuntu.com')
-    sudo('add-apt-repository ppa:certbot/certbot')
-    fabtools.deb.update_index()
-    fabtools.deb.upgrade(safe=True)
-    fabtools.deb.install([
-        'software-properties-common',
-        'python-certbot-nginx'
-    ])
+    with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+        out = sudo('openssl x509 -in {0} -noout -enddate && '
+                   'openssl x509 -in {0} -noout -text | '
+                   'grep -o "DNS:[^,]*"'.format(quote(path)))
+    if out.failed:
+        return None
+    certificate = {'domains': [], 'expires': None}
+    for line in out.splitlines():
+        line = line.strip()
+        if line.startswith('notAfter='):
+            expires = datetime.strptime(' '.join(line[9:].split()),
+                                        '%b %d %H:%M:%S %Y %Z')
+            certificate['expires'] = calendar.timegm(expires.timetuple())
+        elif line.startswith('DNS:'):
+            certificate['domains'].append(line[4:])
+    return certificate if certificate['expires'] else None
+
+
+def is_valid(certificate, domains):
+    """
+    Returns True if a certificate covers the domains and does not expire
+    within ssl.renew_before days
+    """
+    renew_before = int(ctx('ssl.renew_before', default=30)) * 86400
+    return certificate is not None and \
+        set(domains) <= set(certificate['domains']) and \
+        certificate['expires'] - time.time() > renew_before
+
+
+def check_certificate(path, domains):
+    """
+    Returns True if the certificate of the host is valid (see is_valid). Its
+    domains and expiry date are cached locally, so an unchanged certificate
+    that does not expire soon is not read again on the next deploys.
+    """
+    if not facts.exists(path):
+        return False
+    index = cache.get_index(get_cache_name())
+    if is_valid(index.get(env.host_string), domains):
+        return True
+    certificate = read_certificate(path)
+    if certificate is not None:
+        # Read again before saving, other hosts may have been saved since
+        index = cache.get_index(get_cache_name())
+        index[env.host_string] = certificate
+        cache.save_index(get_cache_name(), index)
+    return is_valid(certificate, domains)
+
+
+def get_certbot_command(domains):
+    """
+    Returns the certbot command issuing (or expanding, renewing) a single
+    certificate for all the domains, without prompting
+    """
+    email = ctx('ssl.email', default=False)
+    return (
+        'certbot certonly --webroot -w {webroot} --cert-name {name} {domains} '
+        '--non-interactive --agree-tos {email} --expand '
+        '--keep-until-expiring'.format(
+            webroot=WEBROOT, name=quote(domains[0]),
+            domains=' '.join('-d {}'.format(quote(d)) for d in domains),
+            email='-m {}'.format(quote(email)) if email else
+            '--register-unsafely-without-email'))
 
 
 @task
+@traced
 def setup():
     """
     Configure SSL with letsencrypt's certbot for the domain
     """
     server_name = ctx("nginx.server_name")
-    path_letsencrypt = '/etc/letsencrypt/live'
-    path_dhparams = '/etc/letsencrypt/ssl-dhparams.pem'
-    path_key = '{}/{}/privkey.pem'.format(path_letsencrypt, server_name)
-    path_cert = '{}/{}/fullchain.pem'.format(path_letsencrypt, server_name)
+    path_dhparams = facts.LETSENCRYPT_DHPARAMS
+    path_options = facts.LETSENCRYPT_OPTIONS
+    path_cert = '{}/{}/fullchain.pem'.format(
+        facts.LETSENCRYPT_LIVE, server_name)
+    options_template, nginx_template = get_templates()
+    domains = get_domains()
 
-    if not fabtools.deb.is_installed('certbot'):
+    if not facts.is_installed('certbot'):
         execute(install)
-        
-    if not files.exists('/etc/letsencrypt/ssl-dhparams.pem', use_sudo=True):
-        sudo('openssl dhparam -out /etc/letsencrypt/ssl-dhparams.pem 2048')
-        
-    if not files.exists('/etc/letsencrypt/options-ssl-nginx.conf', use_sudo=True):
-        upload_template('options-ssl-nginx.conf.template',
-                        '/etc/letsencrypt/options-ssl-nginx.conf')
-
-    if not files.exists(path_cert, use_sudo=True):
-        upload_template('nginx_letsencrypt_init.template',
-                        ctx('nginx.config_path'))
-        sudo('certbot --authenticator webroot --installer nginx -d {}'.format(
-            server_name))
-
-    upload_template('nginx_letsencrypt.template', ctx('nginx.config_path'),
-                    context={
-                        'ssl': {
-                            'letsencrypt': True,
-                            'dhparams': path_dhparams,
-                            'key': path_key,
-                            'cert': path_cert,
-                        }
-                    })
+
+    if not facts.exists(path_dhparams):
+        # The RFC 7919 ffdhe2048 group (the one certbot ships), instead of
+        # generating parameters on the host
+        upload_template('ssl-dhparams.pem.template', path_dhparams)
+        facts.set_path(path_dhparams)
+
+    if not facts.exists(path_options):
+        upload_template(*options_template[:2], **options_template[2])
+        facts.set_path(path_options)
+
+    if not check_certificate(path_cert, domains):
+        print(cyan('Requesting a certificate for {} on {}'.format(
+            ', '.join(domains), env.host)))
+        # nginx has to serve the challenges of all the domains, with the
+        # initial config until there is a certificate
+        if facts.exists(path_cert):
+            upload_template(*nginx_template[:2], **nginx_template[2])
+        else:
+            upload_template('nginx_letsencrypt_init.template',
+                            ctx('nginx.config_path'),
+                            context={'server_names': domains})
+        sudo('mkdir -p {} && service nginx reload && {}'.format(
+            WEBROOT, get_certbot_command(domains)))
+        facts.set_path(path_cert)
+        record_change(path_cert)
+        check_certificate(path_cert, domains)
+        print(green('Certificate issued for {} on {}'.format(
+            ', '.join(domains), env.host)))
+
+    upload_template(*nginx_template[:2], **nginx_template[2])
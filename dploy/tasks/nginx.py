@@ -1,47 +1,80 @@
-from fabric.contrib import files
-from fabric.api import task, sudo, env, execute
-from fabric.colors import cyan
+from fabric.api import task, sudo, env, execute, settings
+from fabric.colors import cyan, red
+from fabric.utils import abort
+from dploy import facts
 from dploy.context import ctx
-from dploy.utils import upload_template
+from dploy.utils import upload_template, has_changed, quote, get_backup_path
+from dploy.trace import traced, budget
+from dploy.tasks import letsencrypt
 
 
-@task
-def setup():
+def get_templates(exists=facts.exists):
     """
-    Configure nginx, will trigger letsencrypt setup if required
+    Returns the (template, path, upload options) of the nginx config,
+    `exists` tells whether the ssl files exist on the host
     """
-    print(cyan('Configuring nginx on {}'.format(env.stage)))
+    if ctx('ssl.letsencrypt'):
+        return letsencrypt.get_templates()
+
     context = {
         'ssl_letsencrypt': False,
         'ssl_with_dhparam': False,
         'ssl_cert': None,
         'ssl_key': None,
     }
-
-    if ctx('ssl.letsencrypt'):
-        execute('letsencrypt.setup')
-    elif ctx('ssl.key') and ctx('ssl.cert'):
-        ssl = True
+    if ctx('ssl.key') and ctx('ssl.cert'):
         dhparams = ctx('ssl.dhparam', default=False)
         key = ctx('ssl.key', default=False)
         cert = ctx('ssl.cert', default=False)
 
-        if key and files.exists(key, use_sudo=True):
+        if key and exists(key):
             context['ssl_key'] = ctx('ssl.key')
-        if cert and files.exists(cert, use_sudo=True):
+        if cert and exists(cert):
             context['ssl_cert'] = ctx('ssl.cert')
-        if dhparams and files.exists(dhparams, use_sudo=True):
+        if dhparams and exists(dhparams):
             context['ssl_with_dhparam'] = True
-        if ssl:
-            upload_template(
-                'nginx_ssl.template', ctx('nginx.config_path'), context=context)
+        template = 'nginx_ssl.template'
     else:
-        upload_template(
-            'nginx.template', ctx('nginx.config_path'), context=context)
+        template = 'nginx.template'
+    return [(template, ctx('nginx.config_path'),
+             {'context': context, 'backup': True})]
 
-    if files.exists(ctx('nginx.document_root'), use_sudo=True):
-        sudo('chown -R {user}:{group} {path}'.format(
-            path=ctx('nginx.document_root'), user=ctx('system.user'),
-            group=ctx('system.group')))
 
-    sudo('service nginx reload')
+@task
+@traced
+@budget(7)
+def setup():
+    """
+    Configure nginx, will trigger letsencrypt setup if required
+    """
+    print(cyan('Configuring nginx on {}'.format(env.stage)))
+    if ctx('ssl.letsencrypt'):
+        execute('letsencrypt.setup')
+    else:
+        for name, path, options in get_templates():
+            upload_template(name, path, **options)
+
+    if has_changed(ctx('nginx.config_path'), '/etc/letsencrypt'):
+        check_config()
+        sudo('service nginx reload')
+
+
+def check_config():
+    """
+    Validates the nginx configuration (nginx -t), a new configuration that
+    does not pass is replaced by its previous version before aborting
+    """
+    path = ctx('nginx.config_path')
+    with settings(warn_only=True):
+        # Backups used to be written next to the config (<path>.bak), where
+        # nginx loads them as another site
+        out = sudo('rm -f {}.bak && nginx -t'.format(quote(path)))
+    if out.succeeded:
+        return
+    if has_changed(path):
+        sudo('if [ -f {0} ]; then cp -f {0} {1}; '
+             'else rm -f {1}; fi'.format(quote(get_backup_path(path)),
+                                         quote(path)))
+        facts.forget(path)
+    abort(red('Invalid nginx configuration on {}, it was not reloaded'.format(
+        env.host)))
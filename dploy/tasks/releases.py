@@ -0,0 +1,121 @@
+import os
+
+from datetime import datetime
+
+from fabric.api import task, sudo, env, execute, hide, settings
+from fabric.utils import abort
+from fabric.colors import cyan, green, red
+from dploy.context import ctx, get_project_dir, releases_enabled
+from dploy.utils import quote, record_change
+from dploy.trace import traced
+
+
+def get_releases():
+    """
+    Returns the release names (oldest first) and the active one
+    """
+    root = ctx('rollbacks.dirs.releases')
+    with settings(hide('running', 'stdout'), warn_only=True):
+        out = sudo('ls -1 {root}; echo "current $(readlink {current})"'.format(
+            root=quote(root), current=quote(get_project_dir())))
+    names, current = [], None
+    for line in out.splitlines():
+        line = line.strip()
+        if line.startswith('current '):
+            current = os.path.basename(line[8:].rstrip('/')) or None
+        elif line:
+            names.append(line)
+    return sorted(names), current
+
+
+def switch(release):
+    """
+    Points the project directory symlink to a release. The symlink is
+    replaced atomically (rename), a project directory that is not a symlink
+    yet (in place deploys) is moved aside first.
+    """
+    project_dir = get_project_dir()
+    target = os.path.join(ctx('rollbacks.dirs.releases'), release)
+    sudo('if [ -d {path} ] && [ ! -L {path} ]; then '
+         'mv {path} {path}.pre-releases; fi; '
+         'ln -sfn {target} {path}.tmp && mv -Tf {path}.tmp {path}'.format(
+             path=quote(project_dir), target=quote(target)))
+    record_change(project_dir)
+
+
+@task
+@traced
+def create():
+    """
+    Starts a new release, following tasks are performed in it
+    """
+    env.release = datetime.now().strftime('%Y%m%d%H%M%S')
+    print(cyan('Creating release {} on {}'.format(env.release, env.stage)))
+
+
+@task
+@traced
+def activate(release=None):
+    """
+    Makes a release (defaults to the one being deployed) the live one
+    """
+    release = release or env.get('release')
+    if not releases_enabled() or not release:
+        return
+    print(cyan('Activating release {} on {}'.format(release, env.stage)))
+    switch(release)
+
+
+@task
+@traced
+def prune(keep=None):
+    """
+    Removes old releases, keeps the last rollbacks.keep ones
+    """
+    if not releases_enabled():
+        return
+    keep = int(keep or ctx('rollbacks.keep', default=5))
+    names, current = get_releases()
+    obsolete = [name for name in names[:-keep] if name != current]
+    if obsolete:
+        print(cyan('Removing {} old release(s) on {}'.format(
+            len(obsolete), env.stage)))
+        root = ctx('rollbacks.dirs.releases')
+        sudo('rm -rf {}'.format(' '.join(
+            quote(os.path.join(root, name)) for name in obsolete)))
+
+
+@task
+@traced
+def show():
+    """
+    Lists the releases, the active one is highlighted
+    """
+    names, current = get_releases()
+    for name in names:
+        if name == current:
+            print(green('{} (active)'.format(name), bold=True))
+        else:
+            print(name)
+
+
+@task
+@traced
+def rollback(release=None):
+    """
+    Activates the previous release (or a given one) and reloads uwsgi
+    """
+    if not releases_enabled():
+        abort(red('Releases are not enabled (rollbacks.enabled)'))
+    names, current = get_releases()
+    if release is None:
+        if current not in names or names.index(current) == 0:
+            abort(red('No release to rollback to on {}'.format(env.host)))
+        release = names[names.index(current) - 1]
+    elif release not in names:
+        abort(red('Unknown release: {}'.format(release)))
+
+    print(cyan('Rolling back {} -> {} on {}'.format(
+        current, release, env.stage)))
+    switch(release)
+    execute('uwsgi.reload', hosts=[env.host_string])
@@ -1,30 +1,62 @@
 import os
-import fabtools
 
-from fabric.api import task, env
+from fabric.api import task, env, sudo, hide, settings
 from fabric.colors import cyan
+from dploy import facts
 from dploy.context import ctx, get_project_dir
-from dploy.utils import upload_template
+from dploy.utils import upload_template, host_state
+from dploy.trace import traced, budget
+
+
+def get_config_path():
+    return os.path.join(
+        ctx('supervisor.dirs.root'),
+        '{}.conf'.format(ctx('nginx.server_name').replace('.', '_')))
+
+
+def get_templates():
+    """
+    Returns the (template, path, upload options) of the supervisor config
+    """
+    uwsgi_ini = os.path.join(get_project_dir(), 'uwsgi.ini')
+    return [('supervisor.template', get_config_path(),
+             {'context': {'uwsgi_ini': uwsgi_ini}})]
+
+
+def get_status(name):
+    """
+    Returns the supervisor status of a program (ex: RUNNING), None if
+    supervisor does not know about it
+    """
+    with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+        out = sudo('supervisorctl status {}'.format(name))
+    tokens = out.strip().split()
+    if len(tokens) < 2 or 'ERROR' in tokens:
+        return None
+    return tokens[1]
 
 
 @task
+@traced
+@budget(6)
 def setup():
     """
-    Configure supervisor to monitor the uwsgi process
+    Configure supervisor to monitor the uwsgi process, the process is
+    restarted by uwsgi.restart
     """
     print(cyan('Configuring supervisor {}'.format(env.stage)))
-    if not fabtools.deb.is_installed('supervisor'):
-        fabtools.deb.install('supervisor')
-    project_dir = get_project_dir()
-    uwsgi_ini = os.path.join(project_dir, 'uwsgi.ini')
+    facts.require_packages('supervisor')
     name = ctx('supervisor.program_name')
-    context = {'uwsgi_ini': uwsgi_ini}
-    dest = os.path.join(
-        ctx('supervisor.dirs.root'),
-        '{}.conf'.format(ctx('nginx.server_name').replace('.', '_')))
-    upload_template('supervisor.template', dest, context=context)
-    fabtools.supervisor.update_config()
-    if fabtools.supervisor.process_status(name) == 'RUNNING':
-        fabtools.supervisor.restart_process(name)
-    elif fabtools.supervisor.process_status(name) == 'STOPPED':
-        fabtools.supervisor.start_process(name)
+    [(template, dest, options)] = get_templates()
+    if upload_template(template, dest, **options):
+        # Only read, the changes of a running program are applied when
+        # uwsgi.restart restarts it (rolling restarts included)
+        sudo('supervisorctl reread')
+    status = get_status(name)
+    if status is None:
+        # New program, added and started
+        sudo('supervisorctl update {}'.format(name))
+        host_state('uwsgi')['restarted'] = True
+    elif status == 'STOPPED':
+        sudo('supervisorctl start {}'.format(name))
+        host_state('uwsgi')['restarted'] = True
@@ -1,12 +1,16 @@
-from jinja2 import Template
-
 from fabric.api import task, env, local, sudo, execute
-from fabric.contrib import files
 from fabric.colors import cyan
-from dploy.context import ctx, get_project_dir
+from dploy import facts
+from dploy.context import (
+    ctx, get_dirs, get_project_dir, get_release_dir, get_venv_path,
+)
+from dploy.commands import chown_command
+from dploy.utils import has_changed, quote
+from dploy.trace import traced
 
 
 @task
+@traced
 def install_dependencies():
     """
     Install system dependencies (dploy.yml:system.packages)
@@ -19,29 +23,28 @@ def install_dependencies():
             local(_cmd)
         else:
             sudo(_cmd)
+            facts.forget_packages()
 
 
 @task
+@traced
 def create_dirs():
     """
     Creates necessary directories and apply user/group permissions
     """
-    paths = []
     print(cyan('Creating directories on {}'.format(env.stage)))
-    for k in env.context.keys():
-        if type(env.context.get(k)) is dict:
-            dirs = env.context.get(k).get('dirs')
-            if dirs:
-                for name, path in dirs.items():
-                    p = Template(path).render(**env.context)
-                    paths.append(p)
-    out = ' '.join(paths)
-    sudo('mkdir -p {paths}'.format(paths=out))
-    sudo('chown -R {user}:{group} {paths}'.format(
-            user=ctx('system.user'), group=ctx('system.group'), paths=out))
+    paths = get_dirs()
+    # Only the directories themselves, the trees the deploy fills are
+    # handled by set_owner
+    sudo('mkdir -p {paths} && {chown}'.format(
+        paths=' '.join(quote(p) for p in paths),
+        chown=chown_command(paths, recursive=False)))
+    for path in paths:
+        facts.set_path(path)
 
 
 @task
+@traced
 def setup():
     """
     System setup
@@ -49,6 +52,29 @@ def setup():
     project_dir = get_project_dir()
     # we install system dependencies only when we are sure the project hasn't
     # been deployed yet
-    if not files.exists(project_dir, use_sudo=True):
+    if not facts.exists(project_dir):
         execute(install_dependencies)
+    # Packages required by the following phases are installed upfront, in a
+    # single apt run, as phases running concurrently would fight for the
+    # dpkg lock
+    facts.require_packages('git', 'supervisor', 'python-virtualenv')
     execute(create_dirs)
+
+
+@task
+@traced
+def set_owner(force=False):
+    """
+    Applies user/group permissions on the code, virtualenv and static files
+    that changed during this run (all of them and the media with force=1)
+    """
+    paths = [get_release_dir(), get_venv_path(),
+             ctx('django.dirs.static_root')]
+    if force in (False, 'False', 'false', '0', 'no'):
+        paths = [p for p in paths if has_changed(p)]
+    else:
+        paths.append(ctx('django.dirs.media_root'))
+    if paths:
+        print(cyan('Setting the owner of {} on {}'.format(
+            ', '.join(paths), env.host)))
+        sudo(chown_command(paths))
@@ -0,0 +1,39 @@
+from fabric.api import task, runs_once
+from fabric.colors import green, red
+from fabric.utils import abort
+from dploy.trace import load, print_summary, print_comparison, get_over_budget
+
+
+@task
+@runs_once
+def report(path):
+    """
+    Prints the summary of a deploy trace file
+    """
+    print_summary(load(path))
+
+
+@task
+@runs_once
+def compare(before, after, threshold=0.1):
+    """
+    Compares the timings of two deploy trace files
+    """
+    print_comparison(load(before), load(after), threshold=float(threshold))
+
+
+@task
+@runs_once
+def budgets(path):
+    """
+    Fails if a task of a deploy trace file made more round-trips than its
+    budget
+    """
+    over = get_over_budget(load(path))
+    for s in over:
+        print(red('{} made {} round-trips on {} (budget: {})'.format(
+            s['name'], s['round_trips'], s['host'], s['budget'])))
+    if over:
+        abort(red('{} task(s) over their round-trip budget'.format(
+            len(over))))
+    print(green('All tasks are within their round-trip budget'))
@@ -1,23 +1,296 @@
 import os
+import json
+import time
 
-from fabric.api import task, sudo, env
-from fabric.colors import cyan
-from dploy.context import ctx, get_project_dir
-from dploy.utils import upload_template
+from fabric.api import task, sudo, env, hide, settings
+from fabric.colors import cyan, green, red
+from fabric.utils import abort
+from dploy import facts
+from dploy.context import (
+    ctx, get_project_dir, get_release_dir, get_venv_path,
+)
+from dploy.commands import python_command
+from dploy.tasks.supervisor import get_config_path
+from dploy.utils import upload_template, has_changed, host_state, quote
+from dploy.trace import traced, budget
+
+# Prints the [pid, status] of the uwsgi workers from the stats server
+STATS_SCRIPT = '''
+import json, socket, sys
+address = sys.argv[1]
+if ':' in address:
+    host, port = address.rsplit(':', 1)
+    sock = socket.create_connection((host or '127.0.0.1', int(port)), 5)
+else:
+    sock = socket.socket(socket.AF_UNIX)
+    sock.connect(address)
+data = b''
+while True:
+    chunk = sock.recv(65536)
+    if not chunk:
+        break
+    data += chunk
+stats = json.loads(data.decode('utf-8'))
+print(json.dumps([[w['pid'], w['status']] for w in stats['workers']]))
+'''
+
+
+# uwsgi.sizing policies: (workers per cpu, threads per worker), the number of
+# workers is always capped by the memory available to them
+POLICIES = {
+    'cpu': (1, 1),
+    'io': (2, 4),
+    'memory': (None, 2),
+}
+
+
+def get_explicit(name, computed):
+    """
+    Returns uwsgi.<name> if it is set in the context, `computed` otherwise
+    """
+    val = ctx('uwsgi.{}'.format(name), default=False)
+    return computed if val is False else int(val)
+
+
+def get_profile(resources):
+    """
+    Returns the worker profile (processes, worker_threads, cheaper,
+    cheaper_initial, listen) of a host from its resources and the
+    uwsgi.sizing policy. Values set explicitly in the context win.
+    """
+    policy = ctx('uwsgi.sizing.policy', default='io')
+    if policy not in POLICIES:
+        abort(red('Unknown uwsgi.sizing.policy: {}'.format(policy)))
+    per_cpu, threads = POLICIES[policy]
+    cpus = resources.get('cpus', 1)
+    memory = resources.get('memory')
+    worker_memory = int(ctx('uwsgi.sizing.worker_memory', default=256))
+    ratio = float(ctx('uwsgi.sizing.memory_ratio', default=0.75))
+
+    processes = None if per_cpu is None else cpus * per_cpu
+    if memory:
+        capped = max(1, int(memory * ratio / worker_memory))
+        processes = capped if processes is None else min(processes, capped)
+    processes = get_explicit('processes', processes or 2)
+    threads = get_explicit('worker_threads', threads)
+
+    # Idle workers are stopped (cheaper subsystem) when there are enough
+    # of them, except for cpu bound apps
+    cheaper = 0
+    if policy != 'cpu' and processes >= 4:
+        cheaper = max(1, processes // 4)
+    cheaper = get_explicit('cheaper', cheaper)
+    cheaper_initial = get_explicit('cheaper_initial',
+                                   max(cheaper, processes // 2))
+
+    # The listen queue cannot be larger than net.core.somaxconn
+    listen = max(100, processes * threads * 8)
+    if resources.get('somaxconn'):
+        listen = min(listen, resources['somaxconn'])
+    listen = get_explicit('listen', listen)
+
+    return {
+        'processes': processes,
+        'worker_threads': threads,
+        'cheaper': cheaper,
+        'cheaper_initial': cheaper_initial,
+        'listen': listen,
+    }
+
+
+def get_chain_reload_file():
+    return os.path.join(get_project_dir(), '.uwsgi-chain-reload')
+
+
+def get_ini_path():
+    """
+    Returns the path of uwsgi.ini, in the release being deployed: the
+    project directory only points to it once it is complete
+    """
+    return os.path.join(get_release_dir(), 'uwsgi.ini')
+
+
+def get_templates(resources):
+    """
+    Returns the (template, path, upload options) of the uwsgi config files
+    """
+    project_dir = get_project_dir()
+    wsgi_file = os.path.join(
+        project_dir, ctx('django.project_name'), 'wsgi.py')
+    context = {
+        'project_dir': project_dir,
+        'wsgi_file': wsgi_file,
+        'chain_reload_file': get_chain_reload_file(),
+        # Merged in the uwsgi.* values of the template context
+        'uwsgi': get_profile(resources),
+    }
+    return [('uwsgi.template', get_ini_path(), {'context': context})]
 
 
 @task
+@traced
+@budget(5)
 def setup():
     """
     Configure uWSGI
     """
     print(cyan('Configuring uwsgi {}'.format(env.stage)))
-    project_dir = get_project_dir()
-    wsgi_file = os.path.join(project_dir, ctx('django.project_name'), 'wsgi.py')
-    uwsgi_ini = os.path.join(project_dir, 'uwsgi.ini')
-    context = {'ctx': ctx, 'project_dir': project_dir, 'wsgi_file': wsgi_file}
+    resources = facts.get_resources()
+    templates = get_templates(resources)
+    profile = templates[0][2]['context']['uwsgi']
+    print(cyan('uwsgi profile on {}: {} workers x {} threads ({} cpus, '
+               '{} MB)'.format(env.host, profile['processes'],
+                               profile['worker_threads'],
+                               resources.get('cpus', '?'),
+                               resources.get('memory', '?'))))
     log_file = '{}/uwsgi.log'.format(ctx('logs.dirs.root'))
-    sudo('touch {logfile}'.format(logfile=log_file))
-    sudo('chown {user}:{group} {logfile}'.format(
+    sudo('touch {logfile} && chown {user}:{group} {logfile}'.format(
         logfile=log_file, user=ctx('system.user'), group=ctx('system.group')))
-    upload_template('uwsgi.template', uwsgi_ini, context=context)
+    for name, path, options in templates:
+        upload_template(name, path, **options)
+
+
+@task
+@traced
+def reload():
+    """
+    Gracefully reload uWSGI workers (supervisor program)
+    """
+    print(cyan('Reloading uwsgi on {}'.format(env.stage)))
+    sudo('supervisorctl signal HUP {}'.format(
+        ctx('supervisor.program_name')))
+
+
+def get_workers():
+    """
+    Returns the [pid, status] of the workers from the uwsgi stats server,
+    None if it is not reachable
+    """
+    with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+        out = sudo('{} {}'.format(
+            python_command('-c {}'.format(quote(STATS_SCRIPT))),
+            quote(ctx('uwsgi.stats'))))
+    if out.failed:
+        return None
+    return parse_workers(out)
+
+
+def parse_workers(out):
+    """
+    Returns the [pid, status] of the workers from the output of
+    STATS_SCRIPT, None if it cannot be parsed
+    """
+    try:
+        return json.loads(out.splitlines()[-1])
+    except (IndexError, ValueError):
+        return None
+
+
+def workers_ready(workers, old_pids=()):
+    """
+    Returns True if there is at least one live worker and all of them are up
+    (idle or busy) and none of them is one of `old_pids`. The workers stopped
+    by the cheaper subsystem (status cheap, pid 0) are not live.
+    """
+    live = [(pid, status) for pid, status in workers or []
+            if pid and status != 'cheap']
+    return bool(live) and all(pid not in old_pids and status in
+                              ('idle', 'busy') for pid, status in live)
+
+
+def get_health_check_url():
+    """
+    Returns the curl arguments probing uwsgi.health_check.url through the
+    local nginx
+    """
+    url = ctx('uwsgi.health_check.url')
+    if url.startswith('http'):
+        return quote(url)
+    server_name = ctx('nginx.server_name')
+    if ctx('ssl.letsencrypt', default=False) or ctx('ssl.cert', default=False):
+        scheme, port = 'https', 443
+    else:
+        scheme, port = 'http', 80
+    return '--resolve {server}:{port}:127.0.0.1 {url}'.format(
+        server=server_name, port=port,
+        url=quote('{}://{}{}'.format(scheme, server_name, url)))
+
+
+def is_healthy(old_pids=()):
+    """
+    Probes the uwsgi stats server (uwsgi.stats), the live workers must be up
+    and none of them can be one of `old_pids` (see workers_ready), then the
+    health check url through nginx (uwsgi.health_check.url)
+    """
+    if ctx('uwsgi.stats', default=False):
+        if not workers_ready(get_workers(), old_pids):
+            return False
+    if ctx('uwsgi.health_check.url', default=False):
+        with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+            out = sudo('curl -fsS -k -o /dev/null -m 5 {}'.format(
+                get_health_check_url()))
+        if out.failed:
+            return False
+    return True
+
+
+def wait_healthy(old_pids=()):
+    """
+    Waits for uwsgi to pass the health check, aborts after
+    uwsgi.health_check.timeout seconds
+    """
+    timeout = int(ctx('uwsgi.health_check.timeout', default=60))
+    interval = float(ctx('uwsgi.health_check.interval', default=2))
+    deadline = time.time() + timeout
+    while not is_healthy(old_pids):
+        if time.time() > deadline:
+            abort(red('uwsgi failed the health check on {} after {}s'.format(
+                env.host, timeout)))
+        time.sleep(interval)
+    print(green('uwsgi is healthy on {}'.format(env.host)))
+
+
+@task
+@traced
+def restart(force=False):
+    """
+    Restarts uWSGI when the code, settings or virtualenv changed (always with
+    force=1) and waits for it to pass the health check. The uwsgi.restart
+    mode is either restart (supervisor), reload (graceful reload) or chain
+    (chain reload, workers are replaced one at a time). A change of the
+    supervisor program config is applied with supervisorctl update.
+    """
+    project_dir = get_project_dir()
+    state = host_state('uwsgi')
+    if state.get('restarted'):
+        # Just (re)started by supervisor
+        wait_healthy()
+        return
+    changed = has_changed(project_dir, get_venv_path(live=True),
+                          get_config_path())
+    if not changed and force in (False, 'False', 'false', '0', 'no'):
+        return
+
+    mode = ctx('uwsgi.restart', default='restart')
+    if has_changed(get_config_path()):
+        # The program config read by supervisor.setup is only applied when
+        # supervisor adds the program again
+        mode = 'update'
+    elif mode == 'chain' and has_changed(get_ini_path()):
+        # A chain reload does not read the uwsgi config again
+        mode = 'reload'
+    old_pids = []
+    if ctx('uwsgi.stats', default=False):
+        old_pids = [pid for pid, status in get_workers() or [] if pid]
+
+    print(cyan('Restarting uwsgi on {} ({})'.format(env.host, mode)))
+    name = ctx('supervisor.program_name')
+    if mode == 'chain':
+        sudo('touch {}'.format(quote(get_chain_reload_file())))
+    elif mode == 'reload':
+        sudo('supervisorctl signal HUP {}'.format(name))
+    elif mode == 'update':
+        sudo('supervisorctl update {}'.format(name))
+    else:
+        sudo('supervisorctl restart {}'.format(name))
+    wait_healthy(old_pids)
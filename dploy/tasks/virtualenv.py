@@ -1,61 +1,102 @@
 import os
-import fabtools
+import hashlib
 
 from fabtools import require
 from fabtools.python import virtualenv as _virtualenv
-from fabric.contrib import files
-from fabric.api import task, env, execute, cd
+from fabric.api import task, env, execute, cd, sudo, hide, settings
 from fabric.colors import cyan
-from dploy.context import ctx, get_project_dir
+from dploy import facts
+from dploy.context import ctx, get_release_dir, get_venv_path
+from dploy.utils import quote, record_change
+from dploy.trace import traced
+
+# Name of the file, inside the virtualenv, holding the digest of the
+# requirements it was installed from
+REQUIREMENTS_MARKER = '.dploy-requirements'
+
+
+def get_requirements_state(venv_path, requirements, extra_requirements):
+    """
+    Returns a (digest, marker) tuple, where digest is the hash of the
+    requirements files, the extra requirements and the python version and
+    marker is the digest of the last successful install (or None)
+    """
+    marker_path = os.path.join(venv_path, REQUIREMENTS_MARKER)
+    with settings(hide('running', 'stdout'), warn_only=True):
+        out = sudo('(cat {reqs}; {venv}/bin/python --version 2>&1) | sha1sum;'
+                   ' cat {marker} 2>/dev/null; true'.format(
+                       reqs=' '.join(map(quote, requirements)) or '/dev/null',
+                       venv=venv_path, marker=quote(marker_path)))
+    lines = out.splitlines() + ['']
+    digest = hashlib.sha1('{}{}'.format(
+        lines[0].split(' ')[0], extra_requirements).encode()).hexdigest()
+    return digest, lines[1].strip() or None
 
 
 @task
+@traced
 def install_requirements(upgrade=False):
     """
     Installs pip requirements
     """
-    project_dir = get_project_dir()
-    requirements_pip = os.path.join(project_dir, 'requirements.pip')
+    project_dir = get_release_dir()
+    venv_path = get_venv_path()
+    requirements = [
+        path for path in (
+            os.path.join(project_dir, 'requirements.pip'),
+            os.path.join(project_dir, 'requirements.txt'),
+        ) if facts.exists(path)]
+    extra_requirements = ctx('virtualenv.extra_requirements',
+                             default=False)
+    if not isinstance(extra_requirements, list):
+        extra_requirements = []
+
+    digest, marker = get_requirements_state(
+        venv_path, requirements, extra_requirements)
+    if not upgrade and digest == marker:
+        print(cyan("Requirements are up to date on {}".format(env.stage)))
+        return
+
+    args = ['-r {}'.format(quote(req)) for req in requirements]
+    for req in extra_requirements:
+        if req.startswith('./'):
+            req = os.path.join(project_dir, req[2:])
+        args.append(quote(req))
+    if not args:
+        return
+
+    # Every requirement is built as a wheel in a per-host wheelhouse once,
+    # later installs (new virtualenvs, requirements changes) reuse them. The
+    # install itself only reads the wheelhouse, not the package index.
+    wheelhouse = ctx('virtualenv.wheelhouse')
+    print(cyan("Installing requirements on {}".format(env.stage)))
     # it is necessary to cd into project dir to support relative
     # paths inside requirements correctly
     with cd(project_dir):
-        if files.exists(requirements_pip, use_sudo=True):
-            print(cyan("Installing requirements.pip on {}".format(env.stage)))
-            with _virtualenv(env.venv_path):
-                fabtools.python.install_requirements(
-                    requirements_pip, upgrade=upgrade, use_sudo=True)
-
-        requirements_txt = os.path.join(project_dir, 'requirements.txt')
-        if files.exists(requirements_txt, use_sudo=True):
-            print(cyan("Installing requirements.txt on {}".format(env.stage)))
-            with _virtualenv(env.venv_path):
-                fabtools.python.install_requirements(
-                    requirements_txt, upgrade=upgrade, use_sudo=True)
-
-        extra_requirements = ctx('virtualenv.extra_requirements',
-                                 default=False)
-        if extra_requirements and isinstance(extra_requirements, list):
-            for req in extra_requirements:
-                print(cyan("Installing {} on {}".format(req, env.stage)))
-                with _virtualenv(env.venv_path):
-                    if req.startswith('./'):
-                        req = os.path.join(project_dir, req[:2])
-                    fabtools.python.install(req, use_sudo=True)
+        sudo('mkdir -p {wheelhouse} && {venv}/bin/pip install -q wheel && '
+             '{venv}/bin/pip wheel -q -w {wheelhouse} -f {wheelhouse} '
+             '{args}'.format(venv=venv_path, wheelhouse=wheelhouse,
+                             args=' '.join(args)))
+        sudo('{venv}/bin/pip install {upgrade}--no-index --find-links '
+             '{wheelhouse} {args}'.format(
+                 venv=venv_path, wheelhouse=wheelhouse, args=' '.join(args),
+                 upgrade='-U ' if upgrade else ''))
+    sudo('echo {} > {}'.format(
+        digest, quote(os.path.join(venv_path, REQUIREMENTS_MARKER))))
+    record_change(venv_path)
 
 
 @task
+@traced
 def setup(upgrade=False):
     """
     Setup virtualenv on the remote location
     """
-    venv_root = ctx('virtualenv.dirs.root')
-    venv_name = ctx('virtualenv.name')
-    venv_path = os.path.join(venv_root, venv_name)
+    venv_path = get_venv_path()
     py = 'python{}'.format(ctx('python.version'))
     env.venv_path = venv_path
 
-    if not fabtools.deb.is_installed('python-virtualenv'):
-        fabtools.deb.install('python-virtualenv')
+    facts.require_packages('python-virtualenv')
     # Experimental
     require.python.virtualenv(venv_path, python_cmd=py, use_sudo=True)
     with _virtualenv(venv_path):
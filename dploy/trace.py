@@ -0,0 +1,222 @@
+"""
+Timing spans for tasks and remote commands.
+
+Spans are stored in the host state so they are sent back from parallel
+phases (see dploy.runner), then written to a JSON trace file and summarized
+at the end of a deploy.
+"""
+import os
+import json
+import time
+import itertools
+import functools
+
+from contextlib import contextmanager
+
+from fabric.api import env
+from fabric.colors import cyan, green, red, yellow
+
+from dploy.utils import HOST_STATE, host_state
+
+_ids = itertools.count()
+
+# Kinds of the spans recorded for each SSH round-trip (see dploy.instrument)
+ROUND_TRIPS = ('exec', 'transfer')
+
+# [name, round-trips] of the tasks being run in this process, innermost last
+_tasks = []
+
+
+@contextmanager
+def span(name, kind='task'):
+    """
+    Records the duration of the enclosed block
+    """
+    record = {
+        'name': name,
+        'kind': kind,
+        'host': env.host_string,
+        'stage': env.get('stage'),
+        'phase': env.get('phase'),
+        'task': _tasks[-1][0] if _tasks else None,
+        'start': time.time(),
+        'ok': False,
+    }
+    try:
+        yield record
+        record['ok'] = True
+    finally:
+        record['duration'] = time.time() - record['start']
+        if kind in ROUND_TRIPS and _tasks:
+            _tasks[-1][1] += 1
+        # Spans are keyed by a unique id so the ones recorded by concurrent
+        # jobs can be merged
+        span_id = '{}.{}'.format(os.getpid(), next(_ids))
+        host_state('trace')[span_id] = record
+
+
+def budget(limit):
+    """
+    Declares the number of round-trips a task is expected to make at most,
+    it must be applied under @traced
+    """
+    def decorator(func):
+        func.budget = limit
+        return func
+    return decorator
+
+
+def traced(func):
+    """
+    Decorator recording a span for each call of a task, named after its
+    module and function (ex: django.migrate), with the number of round-trips
+    it made and its budget. The round-trips of the tasks it runs are counted
+    in their own span.
+    """
+    name = '{}.{}'.format(func.__module__.split('.')[-1], func.__name__)
+    limit = getattr(func, 'budget', None)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with span(name) as record:
+            _tasks.append([name, 0])
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record['round_trips'] = _tasks.pop()[1]
+                record['budget'] = limit
+                if limit is not None and record['round_trips'] > limit:
+                    print(yellow('{} made {} round-trips on {} (budget: '
+                                 '{})'.format(name, record['round_trips'],
+                                              env.host, limit)))
+    return wrapper
+
+
+def get_over_budget(spans):
+    """
+    Returns the task spans that made more round-trips than their budget
+    """
+    return [s for s in spans if s.get('budget') is not None and
+            s.get('round_trips', 0) > s['budget']]
+
+
+def get_spans():
+    """
+    Returns the spans recorded on every host, oldest first
+    """
+    spans = []
+    for state in HOST_STATE.values():
+        spans.extend(state.get('trace', {}).values())
+    return sorted(spans, key=lambda s: s['start'])
+
+
+def save(path, spans=None):
+    with open(path, 'w') as fd:
+        json.dump({
+            'stage': env.get('stage'),
+            'spans': get_spans() if spans is None else spans,
+        }, fd, indent=2)
+
+
+def load(path):
+    with open(path, 'r') as fd:
+        return json.load(fd)['spans']
+
+
+def summarize(spans):
+    """
+    Returns {(kind, name): (calls, total duration, max duration)}
+    """
+    summary = {}
+    for s in spans:
+        calls, total, longest = summary.get((s['kind'], s['name']), (0, 0, 0))
+        summary[(s['kind'], s['name'])] = (
+            calls + 1, total + s['duration'], max(longest, s['duration']))
+    return summary
+
+
+def print_summary(spans=None, limit=20):
+    """
+    Prints the time spent per phase and host, then the slowest tasks and
+    remote commands
+    """
+    spans = get_spans() if spans is None else spans
+    phases = {}
+    for s in spans:
+        if s['kind'] == 'phase':
+            phases.setdefault(s['name'], {})[s['host']] = s
+    print(cyan('{:<40} {:<30} {:>10}'.format('Phase', 'Host', 'Seconds'),
+               bold=True))
+    for name, hosts in sorted(phases.items(),
+                              key=lambda i: min(s['start'] for s in
+                                                i[1].values())):
+        for host, s in sorted(hosts.items(), key=lambda i: str(i[0])):
+            line = '{:<40} {:<30} {:>10.2f}'.format(
+                name, host or '<local-only>', s['duration'])
+            print(green(line) if s['ok'] else red(line))
+
+    summary = summarize(s for s in spans if s['kind'] != 'phase')
+    print(cyan('{:<10} {:<58} {:>5} {:>10} {:>10}'.format(
+        'Kind', 'Name', 'Calls', 'Total', 'Max'), bold=True))
+    slowest = sorted(summary.items(), key=lambda i: -i[1][1])[:limit]
+    for (kind, name), (calls, total, longest) in slowest:
+        print('{:<10} {:<58} {:>5} {:>10.2f} {:>10.2f}'.format(
+            kind, name[:58], calls, total, longest))
+    print_round_trips(spans, limit)
+
+
+def print_round_trips(spans, limit=20):
+    """
+    Prints the round-trips, their latency and bytes per task, then the
+    call sites making the most round-trips
+    """
+    tasks, sites = {}, {}
+    for s in spans:
+        if s['kind'] == 'task':
+            calls, most, budget = tasks.get(s['name'], (0, 0, None))
+            tasks[s['name']] = (calls + 1,
+                                max(most, s.get('round_trips', 0)),
+                                s.get('budget'))
+        elif s['kind'] in ROUND_TRIPS:
+            count, total, size = sites.get(s['name'], (0, 0, 0))
+            sites[s['name']] = (count + 1, total + s['duration'],
+                                size + s.get('bytes', 0))
+    if not sites:
+        return
+    print(cyan('{:<48} {:>5} {:>12} {:>10}'.format(
+        'Task', 'Calls', 'Round-trips', 'Budget'), bold=True))
+    for name, (calls, most, budget) in sorted(
+            tasks.items(), key=lambda i: -i[1][1])[:limit]:
+        line = '{:<48} {:>5} {:>12} {:>10}'.format(
+            name[:48], calls, most, '-' if budget is None else budget)
+        print(red(line) if budget is not None and most > budget else line)
+    print(cyan('{:<48} {:>5} {:>12} {:>10}'.format(
+        'Call site', 'Calls', 'Seconds', 'Bytes'), bold=True))
+    for name, (count, total, size) in sorted(
+            sites.items(), key=lambda i: -i[1][0])[:limit]:
+        print('{:<48} {:>5} {:>12.2f} {:>10}'.format(
+            name[-48:], count, total, size))
+
+
+def print_comparison(before, after, threshold=0.1):
+    """
+    Prints the total duration of each task/command of two traces, entries
+    that got slower by more than `threshold` (ratio) are highlighted
+    """
+    before, after = summarize(before), summarize(after)
+    print(cyan('{:<10} {:<48} {:>10} {:>10} {:>9}'.format(
+        'Kind', 'Name', 'Before', 'After', 'Delta'), bold=True))
+    for key in sorted(set(before) | set(after)):
+        old = before.get(key, (0, 0, 0))[1]
+        new = after.get(key, (0, 0, 0))[1]
+        delta = (new - old) / old if old else 0
+        line = '{:<10} {:<48} {:>10.2f} {:>10.2f} {:>+8.0%}'.format(
+            key[0], key[1][:48], old, new, delta)
+        if old and delta > threshold:
+            print(red(line))
+        elif old and delta < -threshold:
+            print(green(line))
+        elif not old:
+            print(yellow(line))
+        else:
+            print(line)
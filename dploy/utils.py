@@ -1,21 +1,36 @@
 import os
-import yaml
+import re
 import dploy
+import hashlib
+import functools
+
+from io import BytesIO
 
 from fabric.colors import red
-from fabric.contrib import files
-from fabric.api import env
+from fabric.api import env, run, sudo, put, hide, settings, serial
+
+from dploy import FabricException  # noqa
 
+try:
+    from shlex import quote
+except ImportError:  # Python 2
+    from pipes import quote
 
-class FabricException(Exception):
-    pass
+# Per-host state shared between the phases of a run (see dploy.runner)
+HOST_STATE = {}
+
+# Where upload_template(backup=True) keeps the previous version of a file,
+# outside of the directories services load their config files from (ex:
+# nginx includes every file of sites-enabled)
+BACKUP_DIR = '/var/backups/dploy'
 
 
 def load_yaml(path):
+    import yaml  # Imported on use, like jinja2 (see dploy.registry)
     try:
         with open(path, 'r') as fd:
             try:
-                rs = yaml.load(fd)
+                rs = yaml.safe_load(fd)
             except yaml.YAMLError as e:
                 rs = None
                 print(red(e))
@@ -24,6 +39,60 @@ def load_yaml(path):
     return rs
 
 
+def host_state(name, host=None):
+    """
+    Returns the `name` state bucket (a dict) of a host, defaults to the
+    current host
+    """
+    host = env.host_string if host is None else host
+    return HOST_STATE.setdefault(host, {}).setdefault(name, {})
+
+
+def record_change(path):
+    """
+    Records that a remote path has been modified on the current host
+    """
+    host_state('changes')[path] = True
+
+
+def has_changed(*paths):
+    """
+    Returns True if any of the given remote paths, or anything under them,
+    has been modified on the current host during this run
+    """
+    for changed in host_state('changes'):
+        for path in paths:
+            if changed == path or \
+                    changed.startswith(path.rstrip('/') + '/'):
+                return True
+    return False
+
+
+def get_backup_path(path):
+    """
+    Returns the path of the backup of a remote file (see upload_template)
+    """
+    return os.path.join(BACKUP_DIR, path.lstrip('/'))
+
+
+def runs_once_per_stage(func):
+    """
+    Like fabric's runs_once (the task runs once, not once per host), but
+    once per stage, hosts and arguments, so `fab on:beta deploy on:prod
+    deploy` deploys both stages
+    """
+    results = {}
+
+    @functools.wraps(func)
+    def decorated(*args, **kwargs):
+        key = (env.get('stage'), tuple(env.hosts), repr(args),
+               repr(sorted(kwargs.items())))
+        if key not in results:
+            results[key] = func(*args, **kwargs)
+        return results[key]
+    return serial(decorated)
+
+
 def parent_dir(p):
     return os.path.abspath(os.path.join(p, os.pardir))
 
@@ -32,14 +101,23 @@ def git_dirname(uri):
     return uri.split('/')[-1].replace('.git', '')
 
 
+def parse_version(v):
+    """
+    Returns the (major, minor) of a version string (ex: 2.2, 1.11.29)
+    """
+    match = re.match(r'\s*(\d+)\.(\d+)', v)
+    if match is None:
+        return (0, 0)
+    return tuple(map(int, match.groups()))
+
+
 def version_supports_migrations(v):
-    major, minor, revision = map(int, v.split('.'))
-    if major > 1:
-        return True
-    elif major == 1 and minor >= 7:
-        return True
-    else:
-        return False
+    return parse_version(v) >= (1, 7)
+
+
+def get_package_template_dir():
+    return os.path.realpath(os.path.join(
+        os.path.dirname(dploy.__file__), '../templates'))
 
 
 def get_template_dir(name):
@@ -51,8 +129,7 @@ def get_template_dir(name):
     local_path = os.path.join(env.base_path, 'dploy/', name)
     if os.path.exists(local_path):
         return 'dploy/'
-    package_path = os.path.realpath(os.path.join(
-        os.path.dirname(dploy.__file__), '../templates'))
+    package_path = get_package_template_dir()
     if os.path.exists(os.path.join(package_path, name)):
         return package_path
     return None
@@ -72,38 +149,89 @@ def select_template(templates):
     return None
 
 
-def upload_template(name, path, **kwargs):
+def render_template(name, template_dir, context):
     """
-    This function takes a template name and a destination path.
+    Renders a template the same way files.upload_template does and returns
+    its content as bytes. Included templates are looked up in the template
+    directory, then in the package templates.
+    """
+    from jinja2 import Environment, FileSystemLoader
+    jenv = Environment(loader=FileSystemLoader(
+        [template_dir, get_package_template_dir()]))
+    text = jenv.get_template(name).render(**context)
+    if not text.endswith('\n'):
+        text += '\n'
+    return text.encode('utf-8')
 
-    It is a proxy function for files.upload_template with sensible defaults and
-    context preseeding.
 
-    It will also lookup for the template at two specific places:
+def remote_digest(path, use_sudo=True):
+    """
+    Returns the sha1 digest of a remote file, None if it does not exist
+    """
+    func = sudo if use_sudo else run
+    with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+        out = func('sha1sum {} 2>/dev/null'.format(quote(path)))
+    if out.failed or not out.strip():
+        return None
+    return out.strip().split(' ')[0]
+
+
+def render_upload(name, **kwargs):
+    """
+    Renders a template the way upload_template does and returns its content
+    as bytes, None if the template could not be found.
+
+    It will lookup for the template at two specific places:
         1. <project_dir>/deploy/
         2. <dploy_package_dir>/templates/
     """
-    _context = env.context
+    extra_context = kwargs.get('context')
+    template_dir = kwargs.get('template_dir') or get_template_dir(name)
+    if not template_dir:
+        # log ?
+        return None
+
+    rendered, index = dploy.context.get_resolved_context(extra_context)
+    _context = dict(rendered)
     _context.update({
-        'ctx': dploy.context.ctx,
-        'project_dir': dploy.context.get_project_dir(),
+        'ctx': functools.partial(dploy.context.lookup, index),
+        'stage': env.stage,
     })
-    if kwargs.get('context'):
-        _context.update(kwargs.get('context'))
-        del kwargs['context']
-    defaults = {
-        'context': _context,
-        'use_jinja': True,
-        'use_sudo': True,
-        'backup': False,
-        'mode': None,
-    }
-    defaults.update(kwargs)
-    if not kwargs.get('template_dir'):
-        defaults['template_dir'] = get_template_dir(name)
-
-    if defaults.get('template_dir'):
-        return files.upload_template(name, path, **defaults)
-    else:
-        # log ?
+    _context.setdefault('project_dir', dploy.context.get_project_dir())
+    _context.setdefault('venv_path', dploy.context.get_venv_path(live=True))
+    return render_template(name, template_dir, _context)
+
+
+def upload_template(name, path, **kwargs):
+    """
+    This function takes a template name and a destination path.
+
+    It is a replacement for files.upload_template with sensible defaults and
+    context preseeding. The template is rendered locally (see render_upload)
+    and only uploaded if its content differs from the remote file.
+
+    With backup=True, the previous version of the file is kept under
+    BACKUP_DIR (see get_backup_path).
+
+    Returns True if the remote file was modified, False if it was already
+    up to date and None if the template could not be found.
+    """
+    content = render_upload(name, **kwargs)
+    if content is None:
         return None
+
+    use_sudo = kwargs.get('use_sudo', True)
+    digest = hashlib.sha1(content).hexdigest()
+    remote = remote_digest(path, use_sudo=use_sudo)
+    if remote == digest:
+        return False
+
+    if remote is not None and kwargs.get('backup', False):
+        func = sudo if use_sudo else run
+        backup = get_backup_path(path)
+        func('mkdir -p {} && cp {} {}'.format(
+            quote(os.path.dirname(backup)), quote(path), quote(backup)))
+    put(BytesIO(content), path, use_sudo=use_sudo, mode=kwargs.get('mode'),
+        temp_dir=kwargs.get('temp_dir', ''))
+    record_change(path)
+    return True
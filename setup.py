@@ -20,7 +20,7 @@ setup(
     author_email='haineault@gmail.com',
     license='MIT',
     url='https://github.com/h3/fabric-contrib-dploy',
-    packages=find_packages(),
+    packages=find_packages(exclude=['tests']),
     include_package_data=True,
     zip_safe=True,
     scripts=['dploy/bin/python-dploy'],
@@ -0,0 +1,116 @@
+import os
+import importlib
+import subprocess
+
+import pytest
+
+from fabric.api import settings
+
+from dploy.utils import HOST_STATE
+
+# The module itself, dploy.tasks.artifact is a lazy stub (see dploy.registry)
+artifact = importlib.import_module('dploy.tasks.artifact')
+
+ARTIFACT = {
+    'name': 'sample-0123456789ab-20260101000000.tar.gz',
+    'sha256': 'e3b0c44298fc1c149afbf4c8996fb924',
+    'revision': '0123456789abcdef',
+    'paths': ['/var/www/vhosts/sample/sample', '/var/www/vhosts/sample/venv'],
+}
+
+
+def ship(tmpdir, path, version, content):
+    staging = str(tmpdir.join('staging'))
+    os.makedirs(staging + path)
+    with open(os.path.join(staging + path, 'version'), 'w') as fd:
+        fd.write(content)
+    subprocess.check_call(['sh', '-c', artifact.swap_command(
+        path, staging, version)])
+    subprocess.check_call(['rm', '-rf', staging])
+
+
+def read(path):
+    with open(os.path.join(path, 'version')) as fd:
+        return fd.read()
+
+
+def test_swap_replaces_a_symlink(tmpdir):
+    path = str(tmpdir.join('project'))
+    os.makedirs(path)
+    ship(tmpdir, path, '20260101000000', 'one')
+    assert os.readlink(path) == path + '.20260101000000'
+    assert read(path) == 'one'
+    ship(tmpdir, path, '20260101000001', 'two')
+    assert os.readlink(path) == path + '.20260101000001'
+    assert read(path) == 'two'
+    # The previous copy and the directory moved aside are removed
+    assert sorted(os.listdir(str(tmpdir))) == [
+        'project', 'project.20260101000001']
+
+
+def test_swap_moves_new_paths_in_place(tmpdir):
+    path = str(tmpdir.join('releases', '20260101000000'))
+    ship(tmpdir, path, '20260101000001', 'one')
+    assert not os.path.islink(path)
+    assert read(path) == 'one'
+
+
+def test_stamp(tmpdir, monkeypatch):
+    stamp = str(tmpdir.join('artifacts', 'current'))
+    monkeypatch.setattr(artifact, 'get_stamp_path', lambda: stamp)
+    subprocess.check_call(['sh', '-c', artifact.stamp_command(ARTIFACT)])
+    with open(stamp) as fd:
+        parsed = artifact.parse_stamp(fd.read())
+    assert parsed == dict((key, ARTIFACT[key]) for key in (
+        'name', 'sha256', 'revision', 'paths'))
+    assert artifact.is_current(parsed, ARTIFACT)
+    assert not artifact.is_current(parsed, dict(ARTIFACT, sha256='0'))
+    assert not artifact.is_current(parsed, dict(ARTIFACT, paths=[
+        '/var/www/vhosts/sample/releases/20260101000000']))
+    assert not artifact.is_current(artifact.parse_stamp(''), ARTIFACT)
+
+
+@pytest.fixture
+def build_host(monkeypatch):
+    values = {'artifact.dirs.root': '/var/cache/dploy/artifacts',
+              'artifact.transfer': 'fanout'}
+    monkeypatch.setattr(artifact, 'ctx', lambda path, default=None:
+                        values.get(path, default))
+    monkeypatch.setattr(artifact, 'execute', lambda *args, **kwargs: None)
+    monkeypatch.setattr(artifact, 'get_paths', lambda: ARTIFACT['paths'])
+    monkeypatch.setattr(artifact, 'get_release_dir', lambda: '/srv/sample')
+    monkeypatch.setattr(artifact, 'get_revision',
+                        lambda path: ARTIFACT['revision'])
+    monkeypatch.setattr(artifact.facts, 'exists', lambda path: True)
+    # web2 has the last artifact, web3 is a new host
+    states = {
+        'web2': {'stamp': dict(ARTIFACT, read=True)},
+        'web3': {'stamp': {'read': True}},
+    }
+    monkeypatch.setattr(artifact, 'run_jobs', lambda jobs, parallel: [
+        (None, states[host]) for phase, host, kwargs in jobs])
+    HOST_STATE['web1'] = {'stamp': dict(ARTIFACT, read=True)}
+    with settings(host_string='web1'):
+        yield values
+    HOST_STATE.clear()
+
+
+def test_reused_artifact_is_sent_to_outdated_hosts(build_host, monkeypatch):
+    sent = []
+    monkeypatch.setattr(artifact, 'fan_out',
+                        lambda path, targets: sent.append((path, targets)))
+    artifact.build(targets=['web1', 'web2', 'web3'])
+    path = '/var/cache/dploy/artifacts/{}'.format(ARTIFACT['name'])
+    assert sent == [(path, ['web3'])]
+    state = HOST_STATE['web1']['artifact']
+    assert state['reused'] and state['path'] == path
+
+
+def test_reused_artifact_is_relayed_to_outdated_hosts(build_host,
+                                                      monkeypatch):
+    build_host['artifact.transfer'] = 'relay'
+    monkeypatch.setattr(artifact, 'relay', lambda path: 'dploy-artifacts/' +
+                        os.path.basename(path))
+    artifact.build(targets=['web1', 'web2', 'web3'])
+    assert HOST_STATE['web1']['artifact']['local'] == \
+        'dploy-artifacts/{}'.format(ARTIFACT['name'])
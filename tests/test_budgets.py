@@ -0,0 +1,148 @@
+"""
+Round-trips of the setup tasks, counted by dploy.instrument against a fake
+host: a cold deploy (nothing on the host) and a no-op one (same config).
+"""
+import re
+import shlex
+import hashlib
+import importlib
+
+import fabric.operations
+import pytest
+
+from fabric.api import env, settings
+from fabric.operations import _AttributeString
+
+import dploy.utils
+from dploy import instrument
+from dploy.context import get_context, reset_context_cache
+from dploy.trace import get_spans, get_over_budget
+from dploy.utils import HOST_STATE
+
+DPLOY_YML = """global:
+    django:
+        project_name: 'sample'
+    git:
+        repository: 'git@example.com:sample/sample.git'
+stages:
+    prod:
+        hosts: ['web1']
+        nginx:
+            server_name: 'example.com'
+            server_ip: '192.0.2.10'
+"""
+
+STAGE_CONTEXT = """django:
+    secret_key: 'budgets'
+"""
+
+TASKS = ('nginx.setup', 'supervisor.setup', 'uwsgi.setup')
+
+
+class FakeHost(object):
+    """
+    Answers the commands dploy sends to a host with supervisor and nginx
+    installed, the uploaded files are kept in `files`
+    """
+    def __init__(self):
+        self.files = {}
+        self.programs = set()
+
+    def run_command(self, command, *args, **kwargs):
+        out, ok = self.answer(command)
+        out = _AttributeString(out)
+        out.command = out.real_command = command
+        out.failed, out.succeeded = not ok, ok
+        out.return_code = 0 if ok else 1
+        out.stderr = ''
+        return out
+
+    def answer(self, command):
+        if 'resource cpus' in command or 'for p in' in command:
+            return self.probe(command), True
+        match = re.match(r'sha1sum (\S+) ', command)
+        if match:
+            path = shlex.split(match.group(1))[0]
+            if path not in self.files:
+                return '', False
+            return '{}  {}'.format(self.files[path], path), True
+        match = re.match(r'supervisorctl (status|update) (\S+)$', command)
+        if match and match.group(1) == 'update':
+            self.programs.add(match.group(2))
+        elif match and match.group(2) not in self.programs:
+            return '{}: ERROR (no such process)'.format(match.group(2)), False
+        elif match:
+            return '{} RUNNING pid 42, uptime 0:01:00'.format(
+                match.group(2)), True
+        return '', True
+
+    def probe(self, command):
+        lines = []
+        if 'resource cpus' in command:
+            lines.extend(['resource cpus 2', 'resource memory 2048',
+                          'resource somaxconn 4096'])
+        match = re.search(r'for p in (.*?); do', command)
+        if match:
+            lines.extend('path {} {}'.format(int(p in self.files), p)
+                         for p in shlex.split(match.group(1)))
+        match = re.search(r"\\n' (.*?) 2>/dev/null", command)
+        if match:
+            lines.extend('package install ok installed {}'.format(p)
+                         for p in shlex.split(match.group(1)))
+        return '\n'.join(lines)
+
+    def put(self, sftp, local_path, remote_path, *args, **kwargs):
+        self.files[remote_path] = hashlib.sha1(
+            local_path.getvalue()).hexdigest()
+        return remote_path
+
+
+@pytest.fixture
+def host(tmpdir, monkeypatch):
+    tmpdir.join('dploy.yml').write(DPLOY_YML)
+    tmpdir.join('prod.yml').write(STAGE_CONTEXT)
+    host = FakeHost()
+    monkeypatch.setitem(instrument._originals, 'run_command',
+                        host.run_command)
+    monkeypatch.setitem(instrument._originals, 'put', host.put)
+    monkeypatch.setattr(fabric.operations, '_run_command',
+                        instrument.run_command)
+    monkeypatch.setattr(dploy.utils, 'put', lambda local, remote, **kwargs:
+                        instrument.sftp_put(None, local, remote))
+    with settings(base_path=str(tmpdir), stage='prod', hosts=['web1'],
+                  host_string='web1', stage_context_file=str(
+                      tmpdir.join('prod.yml'))):
+        env.context = get_context()
+        reset_context_cache()
+        yield host
+    reset_context_cache()
+    HOST_STATE.clear()
+
+
+def deploy():
+    """
+    Runs the setup tasks on the fake host as a new deploy, returns the
+    {task: (round-trips, budget)} it made
+    """
+    HOST_STATE.clear()
+    for name in TASKS:
+        module, task = name.split('.')
+        getattr(importlib.import_module('dploy.tasks.' + module), task)()
+    assert get_over_budget(get_spans()) == []
+    return dict((s['name'], (s['round_trips'], s['budget']))
+                for s in get_spans() if s['kind'] == 'task')
+
+
+def test_budgets(host):
+    cold = deploy()
+    # nginx: sha1sum, put, nginx -t, reload. supervisor: facts probe,
+    # sha1sum, put, reread, status, update. uwsgi: touch, sha1sum, put
+    assert cold == {'nginx.setup': (4, 7), 'supervisor.setup': (6, 6),
+                    'uwsgi.setup': (3, 5)}
+    assert '/etc/nginx/sites-enabled/example.com' in host.files
+
+    # nginx: sha1sum. supervisor: facts probe, sha1sum, status. uwsgi:
+    # touch, sha1sum
+    noop = deploy()
+    assert noop == {'nginx.setup': (1, 7), 'supervisor.setup': (3, 6),
+                    'uwsgi.setup': (2, 5)}
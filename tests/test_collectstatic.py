@@ -0,0 +1,76 @@
+import os
+import sys
+import json
+import subprocess
+
+import pytest
+
+from dploy.utils import get_package_template_dir
+
+SCRIPT = os.path.join(get_package_template_dir(), 'collectstatic.py.template')
+
+SETTINGS = """SECRET_KEY = 'collectstatic'
+INSTALLED_APPS = ['django.contrib.staticfiles']
+STATIC_URL = '/static/'
+STATIC_ROOT = {static_root!r}
+STATICFILES_DIRS = [{source!r}]
+"""
+
+
+@pytest.fixture
+def project(tmpdir):
+    pytest.importorskip('django')
+    source = tmpdir.mkdir('source')
+    source.join('a.css').write('a { color: red; }')
+    source.join('b.css').write('b { color: blue; }')
+    tmpdir.join('collect_settings.py').write(SETTINGS.format(
+        static_root=str(tmpdir.join('static')), source=str(source)))
+    return tmpdir
+
+
+def collectstatic(project, limit=10):
+    """
+    Runs the script the way django.collectstatic does, returns its mode and
+    the number of changed files
+    """
+    out = subprocess.check_output(
+        [sys.executable, SCRIPT, 'collect_settings',
+         str(project.join('manifest.json')), '0', str(limit)],
+        cwd=str(project)).decode('utf-8')
+    mode, count = out.splitlines()[-1].split()[1:]
+    return mode, int(count)
+
+
+def test_manifest_diff(project):
+    manifest = project.join('manifest.json')
+    static = project.join('static')
+    # Without a manifest, collectstatic runs in full and dploy moves the
+    # pending manifest in place
+    assert collectstatic(project) == ('full', 2)
+    assert not manifest.exists()
+    with open(str(manifest) + '.pending') as fd:
+        assert sorted(json.load(fd)) == ['a.css', 'b.css']
+    os.rename(str(manifest) + '.pending', str(manifest))
+
+    assert collectstatic(project) == ('unchanged', 0)
+    # Only the content matters
+    os.utime(str(project.join('source', 'a.css')), None)
+    assert collectstatic(project) == ('unchanged', 0)
+
+    project.join('source', 'a.css').write('a { color: green; }')
+    assert collectstatic(project) == ('partial', 1)
+    assert static.join('a.css').read() == 'a { color: green; }'
+
+    static.join('b.css').write('b { color: blue; }')
+    project.join('source', 'b.css').remove()
+    assert collectstatic(project) == ('partial', 1)
+    assert not static.join('b.css').exists()
+    assert collectstatic(project) == ('unchanged', 0)
+
+
+def test_too_many_changes(project):
+    assert collectstatic(project) == ('full', 2)
+    os.rename(str(project.join('manifest.json')) + '.pending',
+              str(project.join('manifest.json')))
+    project.join('source', 'a.css').write('a { color: green; }')
+    assert collectstatic(project, limit=0) == ('full', 1)
@@ -0,0 +1,47 @@
+import subprocess
+
+import pytest
+
+from fabric.operations import _AttributeString
+
+from dploy import FabricException, commands
+
+
+@pytest.fixture
+def sudo(monkeypatch):
+    """
+    Runs the remote commands locally
+    """
+    calls = []
+
+    def _sudo(command):
+        calls.append(command)
+        process = subprocess.Popen(['sh', '-c', command],
+                                   stdout=subprocess.PIPE)
+        out = _AttributeString(process.communicate()[0].decode('utf-8')
+                               .rstrip('\n'))
+        out.return_code = process.returncode
+        out.failed = process.returncode != 0
+        out.succeeded = not out.failed
+        return out
+    monkeypatch.setattr(commands, 'sudo', _sudo)
+    monkeypatch.setattr(commands, 'get_release_dir', lambda: '/tmp')
+    return calls
+
+
+def test_batch(sudo):
+    results = commands.batch(['echo one', 'true', 'printf "two\\nthree"'])
+    assert len(sudo) == 1
+    assert results == [
+        ('echo one', 0, 'one'),
+        ('true', 0, ''),
+        ('printf "two\\nthree"', 0, 'two\nthree'),
+    ]
+
+
+def test_batch_stops_at_the_first_failure(sudo, capsys):
+    with pytest.raises(FabricException) as e:
+        commands.batch(['echo one', 'echo two; exit 3', 'echo never'])
+    assert 'echo two; exit 3' in str(e.value)
+    out = capsys.readouterr().out
+    assert 'one' in out and 'two' in out and 'never' not in out
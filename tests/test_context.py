@@ -0,0 +1,76 @@
+from fabric.api import settings
+
+import dploy.context
+from dploy.context import (
+    ctx, render_context, flatten_context, reset_context_cache,
+)
+
+
+def test_render_context():
+    context = {
+        'nginx': {
+            'server_name': 'example.com',
+            'document_root': '/var/www/vhosts/{{ nginx["server_name"] }}',
+        },
+        'django': {
+            'dirs': {
+                'static_root': '{{ nginx["document_root"] }}/static',
+            },
+            'settings_module': '{{ stage }}_settings',
+        },
+        'hosts': ['{{ nginx["server_name"] }}', 'www.example.com'],
+        'processes': 4,
+    }
+    with settings(stage='prod'):
+        rendered = render_context(context)
+    assert rendered['nginx']['document_root'] == '/var/www/vhosts/example.com'
+    # Rendered again until the values referencing templated ones are done
+    assert rendered['django']['dirs']['static_root'] == \
+        '/var/www/vhosts/example.com/static'
+    assert rendered['django']['settings_module'] == 'prod_settings'
+    assert rendered['hosts'] == ['example.com', 'www.example.com']
+    assert rendered['processes'] == 4
+    # The context itself is left untouched
+    assert context['django']['settings_module'] == '{{ stage }}_settings'
+
+
+def test_flatten_context():
+    context = {
+        'nginx': {'server_name': 'example.com'},
+        'django': {'dirs': {'static_root': '/static'}},
+        'hosts': ['a', 'b'],
+    }
+    assert flatten_context(context) == {
+        'nginx': {'server_name': 'example.com'},
+        'nginx.server_name': 'example.com',
+        'django': {'dirs': {'static_root': '/static'}},
+        'django.dirs': {'static_root': '/static'},
+        'django.dirs.static_root': '/static',
+        'hosts': ['a', 'b'],
+    }
+
+
+def test_context_overlay_is_compiled_once(monkeypatch):
+    compiled = []
+
+    def compile_context(context):
+        compiled.append(context)
+        return real_compile_context(context)
+
+    real_compile_context = dploy.context.compile_context
+    monkeypatch.setattr(dploy.context, 'compile_context', compile_context)
+    context = {
+        'nginx': {'server_name': 'example.com'},
+        'uwsgi': {'pass': '/dev/shm/{{ nginx["server_name"] }}.sock'},
+    }
+    with settings(stage='prod', host_string=None, context=context):
+        reset_context_cache()
+        assert ctx('uwsgi.pass') == '/dev/shm/example.com.sock'
+        overlay = {'nginx': {'server_name': 'example.org'}}
+        assert ctx('nginx.server_name', context=overlay) == 'example.org'
+        assert ctx('nginx.server_name', context=dict(overlay)) == \
+            'example.org'
+        assert len(compiled) == 2
+        # The base context is left untouched
+        assert ctx('nginx.server_name') == 'example.com'
+        reset_context_cache()
@@ -0,0 +1,54 @@
+import importlib
+
+import pytest
+
+from fabric.api import env
+
+from dploy import FabricException
+
+# The module itself, dploy.tasks.django is a lazy stub (see dploy.registry)
+django = importlib.import_module('dploy.tasks.django')
+
+
+@pytest.fixture
+def version(monkeypatch):
+    monkeypatch.setitem(env, 'stage', 'prod')
+    monkeypatch.setitem(env, 'host', 'web1')
+    versions = ['2.2.28']
+    monkeypatch.setattr(django, 'get_version', lambda: versions[0])
+    return versions
+
+
+def test_jsonl_needs_django_3_2(version, monkeypatch):
+    dumps = []
+    monkeypatch.setattr(django, 'dump', lambda *args: dumps.append(args))
+    with pytest.raises(FabricException):
+        django.dumpdata('blog', dest='blog.jsonl.gz', format='jsonl')
+    assert dumps == []
+    version[0] = '3.2.1'
+    django.dumpdata('blog', dest='blog.jsonl.gz', format='jsonl')
+    assert dumps == [(['blog'], 'blog.jsonl.gz', 'jsonl', False)]
+
+
+def test_loaddata_checks_the_version_first(version, monkeypatch, tmpdir):
+    streamed = []
+    monkeypatch.setattr(django, 'stream_in',
+                        lambda command, fd, label, compress: streamed.append(
+                            label))
+    path = tmpdir.join('blog.jsonl.gz')
+    path.write('')
+    with pytest.raises(FabricException):
+        django.loaddata(str(path))
+    version[0] = '1.11.29'
+    path = tmpdir.join('blog.json.gz')
+    path.write('')
+    with pytest.raises(FabricException):
+        django.loaddata(str(path))
+    assert streamed == []
+
+
+def test_dump_format():
+    assert django.get_dump_format('dump/blog.Post.jsonl.gz') == 'jsonl'
+    assert django.get_dump_format('data.json') == 'json'
+    with pytest.raises(FabricException):
+        django.get_dump_format('data.xml.gz')
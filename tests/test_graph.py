@@ -0,0 +1,44 @@
+import pytest
+
+from dploy import FabricException
+from dploy.graph import get_waves
+
+
+def phase(name, requires=(), provides=()):
+    return {'name': name, 'requires': list(requires),
+            'provides': list(provides)}
+
+
+def test_waves():
+    phases = [
+        phase('git.checkout', requires=['dirs'], provides=['code']),
+        phase('system.dirs', provides=['dirs']),
+        phase('virtualenv.setup', requires=['code'], provides=['venv']),
+        phase('django.setup_settings', requires=['code'],
+              provides=['settings']),
+        phase('nginx.setup', requires=['dirs']),
+        phase('django.migrate', requires=['venv', 'settings']),
+    ]
+    assert get_waves(phases) == [
+        ['system.dirs'],
+        ['git.checkout', 'nginx.setup'],
+        ['virtualenv.setup', 'django.setup_settings'],
+        ['django.migrate'],
+    ]
+
+
+def test_waves_ignore_unprovided_requirements():
+    phases = [
+        phase('uwsgi.setup', requires=['code', 'settings']),
+        phase('git.checkout', requires=['code'], provides=['code']),
+    ]
+    assert get_waves(phases) == [['git.checkout'], ['uwsgi.setup']]
+
+
+def test_circular_dependency():
+    phases = [
+        phase('a', requires=['b'], provides=['a']),
+        phase('b', requires=['a'], provides=['b']),
+    ]
+    with pytest.raises(FabricException):
+        get_waves(phases)
@@ -0,0 +1,44 @@
+"""
+`import dploy.tasks` (done by every fabfile) must not import the task
+modules nor fabtools, they are loaded when a task runs (see dploy.registry).
+"""
+import os
+import sys
+import json
+import subprocess
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Seconds, the import takes about 25ms on a laptop
+IMPORT_BOUND = 0.25
+
+SCRIPT = '''
+import sys, json, time, warnings
+warnings.simplefilter('ignore')
+import fabric.api  # Imported by fab before the fabfile
+start = time.time()
+import dploy.tasks
+duration = time.time() - start
+print(json.dumps({
+    'duration': duration,
+    'modules': sorted(m for m in sys.modules
+                      if m.startswith('dploy.tasks.') or
+                      m.split('.')[0] in ('fabtools', 'yaml', 'jinja2')),
+}))
+'''
+
+
+def import_tasks():
+    environ = dict(os.environ, PYTHONPATH=ROOT_DIR)
+    out = subprocess.check_output([sys.executable, '-c', SCRIPT],
+                                  cwd=ROOT_DIR, env=environ)
+    return json.loads(out.decode('utf-8').strip().splitlines()[-1])
+
+
+def test_import_loads_no_task_module():
+    assert import_tasks()['modules'] == []
+
+
+def test_import_time():
+    # Best of three, the first run may also pay for the bytecode compilation
+    duration = min(import_tasks()['duration'] for i in range(3))
+    assert duration < IMPORT_BOUND
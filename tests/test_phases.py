@@ -0,0 +1,16 @@
+from dploy.tasks import PHASES, get_waves
+
+
+def get_wave(waves, name):
+    return [i for i, wave in enumerate(waves) if name in wave][0]
+
+
+def test_release_is_activated_once_complete():
+    # All the phases, as with releases and artifact enabled
+    waves = get_waves(list(PHASES.values()))
+    activate = get_wave(waves, 'releases.activate')
+    for name in ('uwsgi.setup', 'system.set_owner', 'django.migrate',
+                 'django.setup_settings', 'artifact.ship'):
+        assert get_wave(waves, name) < activate
+    for name in ('supervisor.setup', 'uwsgi.restart', 'releases.prune'):
+        assert get_wave(waves, name) > activate
@@ -0,0 +1,18 @@
+from fabric.api import env, settings
+
+import dploy.tasks
+
+
+def test_render_once_per_stage(monkeypatch):
+    rendered = []
+    monkeypatch.setattr(dploy.tasks, 'render_templates',
+                        lambda output, hosts: rendered.append(
+                            (env.stage, hosts)) or {})
+    monkeypatch.setattr(dploy.tasks, 'print_changes', lambda *args: None)
+    monkeypatch.setattr(dploy.tasks, 'reset_context_cache', lambda: None)
+    # fab on:beta render on:prod render, each called once per host
+    for stage in ('beta', 'beta', 'prod', 'prod'):
+        with settings(stage=stage, hosts=['{}.example.com'.format(stage)]):
+            dploy.tasks.render()
+    assert rendered == [('beta', ['beta.example.com']),
+                        ('prod', ['prod.example.com'])]
@@ -0,0 +1,41 @@
+from fabric.api import env, settings
+
+from dploy.runner import run_phase, run_jobs
+from dploy.utils import runs_once_per_stage
+
+
+def test_runs_once_per_stage():
+    calls = []
+
+    @runs_once_per_stage
+    def deploy():
+        calls.append(env.stage)
+        return env.stage
+
+    # Called once per host by fab
+    with settings(stage='beta', hosts=['a', 'b']):
+        assert deploy() == 'beta'
+        assert deploy() == 'beta'
+    with settings(stage='prod', hosts=['c']):
+        assert deploy() == 'prod'
+    assert calls == ['beta', 'prod']
+
+
+def test_run_phase_reports_any_error():
+    def broken():
+        return {}['databases']
+
+    error, state = run_phase(broken)
+    assert error == "KeyError: 'databases'"
+
+
+def test_run_jobs_reports_errors_in_serial_mode():
+    def broken():
+        raise RuntimeError('Network is unreachable')
+
+    def working():
+        return True
+
+    results = run_jobs([(broken, None, {}), (working, None, {})])
+    assert [error for error, state in results] == [
+        'RuntimeError: Network is unreachable', None]
@@ -0,0 +1,15 @@
+from dploy.utils import parse_version, version_supports_migrations
+
+
+def test_parse_version():
+    assert parse_version('2.2') == (2, 2)
+    assert parse_version('1.11.29') == (1, 11)
+    assert parse_version('3.2.25\n') == (3, 2)
+    assert parse_version('4.0rc1') == (4, 0)
+    assert parse_version('unknown') == (0, 0)
+    assert parse_version('1.11') > parse_version('1.8')
+
+
+def test_version_supports_migrations():
+    assert version_supports_migrations('1.7.11')
+    assert not version_supports_migrations('1.6.11')
@@ -0,0 +1,129 @@
+import os
+import sys
+import json
+import socket
+import tempfile
+import importlib
+import threading
+import subprocess
+
+import pytest
+
+from dploy import FabricException
+from dploy.tasks.uwsgi import STATS_SCRIPT, parse_workers, workers_ready
+
+# The module itself, dploy.tasks.uwsgi is a lazy stub (see dploy.registry)
+uwsgi = importlib.import_module('dploy.tasks.uwsgi')
+
+# Stats of a uwsgi with 4 processes, 2 of them stopped by the cheaper
+# subsystem (processes=4, cheaper=1, cheaper_initial=2)
+STATS = {
+    'version': '2.0.18',
+    'workers': [
+        {'id': 1, 'pid': 101, 'status': 'idle', 'requests': 10},
+        {'id': 2, 'pid': 102, 'status': 'busy', 'requests': 12},
+        {'id': 3, 'pid': 0, 'status': 'cheap', 'requests': 0},
+        {'id': 4, 'pid': 0, 'status': 'cheap', 'requests': 0},
+    ],
+}
+
+
+def serve_stats(stats):
+    """
+    Serves a stats payload once on a unix socket, the way the uwsgi stats
+    server does, returns its address
+    """
+    address = os.path.join(tempfile.mkdtemp(), 'stats.sock')
+    server = socket.socket(socket.AF_UNIX)
+    server.bind(address)
+    server.listen(1)
+
+    def serve():
+        conn, addr = server.accept()
+        conn.sendall(json.dumps(stats).encode('utf-8'))
+        conn.close()
+        server.close()
+    threading.Thread(target=serve).start()
+    return address
+
+
+def get_workers(stats):
+    out = subprocess.check_output(
+        [sys.executable, '-c', STATS_SCRIPT, serve_stats(stats)])
+    return parse_workers(out.decode('utf-8'))
+
+
+def test_cheaped_workers_are_skipped():
+    workers = get_workers(STATS)
+    assert workers == [[101, 'idle'], [102, 'busy'], [0, 'cheap'],
+                       [0, 'cheap']]
+    assert workers_ready(workers)
+    # The pids of the workers before the restart never include 0
+    assert workers_ready(workers, old_pids=[201, 202])
+
+
+def test_old_workers_are_not_ready():
+    assert not workers_ready(get_workers(STATS), old_pids=[101])
+
+
+def test_workers_starting_are_not_ready():
+    assert not workers_ready([[101, 'idle'], [102, 'loading']])
+
+
+def test_no_live_worker_is_not_ready():
+    assert not workers_ready([[0, 'cheap'], [0, 'cheap']])
+    assert not workers_ready([])
+    assert not workers_ready(None)
+
+
+def test_unparsable_stats():
+    assert parse_workers('') is None
+    assert parse_workers('Traceback (most recent call last):') is None
+
+
+@pytest.fixture
+def context(monkeypatch):
+    values = {}
+    monkeypatch.setattr(uwsgi, 'ctx', lambda path, default=None:
+                        values.get(path, default))
+    return values
+
+
+def test_profile_io(context):
+    assert uwsgi.get_profile({'cpus': 2, 'memory': 2048}) == {
+        'processes': 4, 'worker_threads': 4, 'cheaper': 1,
+        'cheaper_initial': 2, 'listen': 128}
+
+
+def test_profile_capped_by_memory(context):
+    # 768 MB for the workers, 256 MB each
+    assert uwsgi.get_profile({'cpus': 8, 'memory': 1024}) == {
+        'processes': 3, 'worker_threads': 4, 'cheaper': 0,
+        'cheaper_initial': 1, 'listen': 100}
+
+
+def test_profile_cpu(context):
+    context['uwsgi.sizing.policy'] = 'cpu'
+    assert uwsgi.get_profile({'cpus': 4, 'somaxconn': 64}) == {
+        'processes': 4, 'worker_threads': 1, 'cheaper': 0,
+        'cheaper_initial': 2, 'listen': 64}
+
+
+def test_profile_memory(context):
+    context['uwsgi.sizing.policy'] = 'memory'
+    assert uwsgi.get_profile({'cpus': 4}) == {
+        'processes': 2, 'worker_threads': 2, 'cheaper': 0,
+        'cheaper_initial': 1, 'listen': 100}
+
+
+def test_profile_explicit_values(context):
+    context.update({'uwsgi.processes': 10, 'uwsgi.listen': '1024'})
+    assert uwsgi.get_profile({'cpus': 1, 'memory': 512}) == {
+        'processes': 10, 'worker_threads': 4, 'cheaper': 2,
+        'cheaper_initial': 5, 'listen': 1024}
+
+
+def test_profile_unknown_policy(context):
+    context['uwsgi.sizing.policy'] = 'fast'
+    with pytest.raises(FabricException):
+        uwsgi.get_profile({'cpus': 1})